@@ -1,13 +1,26 @@
-from typing import Any
+from typing import Any, Dict, Iterable, Optional
 
+import asyncio
 import discord
 import logging
+import time
 
+from discord.ext import tasks
 from redbot.core import Config
 from redbot.core import commands
 
+from .threads import ForumThreadIndex, diff_role_members
+
 log = logging.getLogger("red.nevcairiel.adforum")
 
+# role edits in flight during a sync, a full sync of a big forum can touch
+# thousands of owners and they all share the same role
+ROLE_EDIT_CONCURRENCY = 4
+# members per gateway member query, the most Discord allows
+MEMBER_QUERY_LIMIT = 100
+# background cycles per full sync, incremental syncs never notice threads deleted while the bot was offline
+RECONCILE_FULL_CYCLES = 24
+
 class AdForum(commands.Cog):
     """AdForum Cog"""
 
@@ -20,49 +33,230 @@ class AdForum(commands.Cog):
 
         default_guild = {
             "forums": {},
+            # thread owners per forum, maintained by syncs and thread events
+            "threads": {},
+            # archive time of the newest archived thread per forum, when it was last synced
+            "archive_marks": {},
         }
         self.config.register_guild(**default_guild)
 
+        # background reconciliation of all forums, disabled with an interval of 0
+        self.config.register_global(reconcile_interval=0, reconcile_max_edits=100)
+
+        # role per tracked forum for each guild, only guilds with forums are present
+        self._forums: Dict[int, Dict[int, int]] = {}
+
+        # thread index per tracked forum, present once the forum was synced
+        self._threads: Dict[int, ForumThreadIndex] = {}
+
+    async def cog_load(self):
+        all_guilds = await self.config.all_guilds()
+        for guild_id, data in all_guilds.items():
+            self._cache_forums(guild_id, data["forums"])
+
+    def _cache_forums(self, guild_id: int, forums: Dict[str, int]) -> None:
+        """Update the cached forums of a guild, after they were changed"""
+        if forums:
+            # convert to int (ints cant be keys in json dicts)
+            self._forums[guild_id] = {int(forum_id): role_id for forum_id, role_id in forums.items()}
+        else:
+            self._forums.pop(guild_id, None)
+
     async def initialize(self):
         await self.bot.wait_until_red_ready()
 
-    async def _process_thread(self, thread: discord.Thread) -> None:
-        forums = await self.config.guild(thread.guild).forums()
-        forum_id = str(thread.parent_id)
-        if forum_id in forums:
-            await thread.owner.add_roles(thread.guild.get_role(forums[forum_id]), reason = "AdForum Thread created")
+        all_guilds = await self.config.all_guilds()
+        for guild_id, data in all_guilds.items():
+            for forum_id, threads in data["threads"].items():
+                self._threads[int(forum_id)] = ForumThreadIndex(threads)
 
-    async def _sync_forum(self, forum: discord.ForumChannel) -> None:
-        forums = await self.config.guild(forum.guild).forums()
-        forum_id = str(forum.id)
-        if forum_id not in forums:
-            log.warning("forum is not being tracked")
+            guild = self.bot.get_guild(guild_id)
+            if not guild:
+                continue
+
+            # forums that were setup before the index existed need one full sync
+            for forum_id in data["forums"]:
+                forum = guild.get_channel(int(forum_id))
+                if forum and forum.id not in self._threads:
+                    await self._sync_forum(forum, full = True)
+
+        interval = await self.config.reconcile_interval()
+        if interval:
+            self.background_reconcile.change_interval(seconds=interval)
+            self.background_reconcile.start()
+
+    async def cog_unload(self):
+        self.background_reconcile.cancel()
+
+    async def _index_thread(self, guild_id: int, forum_id: int, thread_id: int, owner_id: int) -> None:
+        index = self._threads.get(forum_id)
+        if index is None:
             return
+
+        index.add(thread_id, owner_id)
+        await self.config.guild_from_id(guild_id).threads.set_raw(str(forum_id), str(thread_id), value = owner_id)
+
+    async def _unindex_thread(self, guild_id: int, forum_id: int, thread_id: int) -> Optional[int]:
+        index = self._threads.get(forum_id)
+        if index is None or thread_id not in index:
+            return None
+
+        owner_id = index.remove(thread_id)
+        await self.config.guild_from_id(guild_id).threads.clear_raw(str(forum_id), str(thread_id))
+        return owner_id
+
+    async def _process_thread(self, thread: discord.Thread, role_id: int) -> None:
+        await self._index_thread(thread.guild.id, thread.parent_id, thread.id, thread.owner_id)
+        owner = (await self._resolve_members(thread.guild, [thread.owner_id])).get(thread.owner_id)
+        if owner:
+            await owner.add_roles(thread.guild.get_role(role_id), reason = "AdForum Thread created")
+
+    async def _resolve_members(self, guild: discord.Guild, member_ids: Iterable[int]) -> Dict[int, discord.Member]:
+        """Get members by ID, members that are not cached are queried over the gateway in chunks
+
+        Members that left the guild are not included.
+        """
+        members = {}
+        missing = []
+        for member_id in member_ids:
+            member = guild.get_member(member_id)
+            if member:
+                members[member_id] = member
+            else:
+                missing.append(member_id)
+
+        # with a complete member cache, the missing members are not in the guild
+        if guild.chunked:
+            return members
+
+        for start in range(0, len(missing), MEMBER_QUERY_LIMIT):
+            chunk = missing[start:start + MEMBER_QUERY_LIMIT]
+            try:
+                for member in await guild.query_members(user_ids = chunk, limit = len(chunk)):
+                    members[member.id] = member
+            except asyncio.TimeoutError:
+                log.warning(f"Querying {len(chunk)} members in guild {guild.id} timed out")
+            except discord.ClientException:
+                log.warning("Querying members requires the members intent")
+                break
+
+        return members
+
+    async def _apply_roles(self, guild: discord.Guild, role: discord.Role, add_ids: Iterable[int], remove_ids: Iterable[int], reason: str, limit: Optional[int] = None) -> int:
+        """Add and remove a role for the given member IDs, returns the number of edits made
+
+        If `limit` is specified, at most that many edits are made, the rest is left for later.
+        """
+        add_ids = set(add_ids)
+        remove_ids = set(remove_ids)
+        members = await self._resolve_members(guild, add_ids | remove_ids)
+
+        # members that left the guild have no roles to change. role.members only has cached members,
+        # so members resolved outside the cache can already have the role
+        changes = [(member, True) for member_id, member in members.items() if member_id in add_ids and not member.get_role(role.id)]
+        changes += [(member, False) for member_id, member in members.items() if member_id in remove_ids and member.get_role(role.id)]
+        if limit is not None and len(changes) > limit:
+            log.info(f"Deferring {len(changes) - limit} changes of role {role.id}")
+            changes = changes[:limit]
+
+        semaphore = asyncio.Semaphore(ROLE_EDIT_CONCURRENCY)
+        edits = 0
+
+        async def edit(member: discord.Member, add: bool) -> None:
+            nonlocal edits
+            async with semaphore:
+                try:
+                    if add:
+                        await member.add_roles(role, reason = reason)
+                    else:
+                        await member.remove_roles(role, reason = reason)
+                    edits += 1
+                except discord.HTTPException:
+                    log.exception(f"Updating role {role.id} of member {member.id} failed")
+
+        await asyncio.gather(*(edit(member, add) for member, add in changes))
+        return edits
+
+    async def _sync_forum(self, forum: discord.ForumChannel, full: bool = False, max_edits: Optional[int] = None) -> int:
+        """Sync the thread index and the role of a forum, returns the number of role edits made
+
+        Unless `full` is set, only threads archived since the previous sync are
+        fetched, older ones are taken from the index.
+        """
+        role_id = self._forums.get(forum.guild.id, {}).get(forum.id)
+        if role_id is None:
+            log.warning("forum is not being tracked")
+            return 0
         
-        role = forum.guild.get_role(forums[forum_id])
+        forum_id = str(forum.id)
+        role = forum.guild.get_role(role_id)
         if not role:
             log.warning("role not found")
-            return
+            return 0
         
-        role_members = role.members
-        user_list = []
+        index = self._threads.get(forum.id)
+        mark = (await self.config.guild(forum.guild).archive_marks()).get(forum_id)
+        if full or index is None or mark is None:
+            index = ForumThreadIndex()
+            mark = None
+
         for thread in forum.threads:
-            user_list.append(thread.owner)
-            if not thread.owner:
-                pass
-            elif thread.owner not in role_members:
-                await thread.owner.add_roles(role, reason = "AdForum Thread sync")
+            index.add(thread.id, thread.owner_id)
 
+        # archived threads are returned newest first, stop at the ones the previous sync got
+        newest = mark
         async for thread in forum.archived_threads(limit = None):
-            user_list.append(thread.owner)
-            if not thread.owner:
-                pass
-            elif thread.owner not in role_members:
-                await thread.owner.add_roles(role, reason = "AdForum Thread sync")
+            archived = thread.archive_timestamp.timestamp()
+            if mark is not None and archived < mark:
+                break
+
+            index.add(thread.id, thread.owner_id)
+            if newest is None or archived > newest:
+                newest = archived
+
+        self._threads[forum.id] = index
+        await self.config.guild(forum.guild).threads.set_raw(forum_id, value = index.to_config())
+        if newest is not None:
+            await self.config.guild(forum.guild).archive_marks.set_raw(forum_id, value = newest)
+        else:
+            await self.config.guild(forum.guild).archive_marks.clear_raw(forum_id)
 
-        for member in role_members:
-            if member not in user_list:
-                await member.remove_roles(role, reason = "AdForum Thread sync")
+        to_add, to_remove = diff_role_members(index.owners(), {member.id for member in role.members})
+        return await self._apply_roles(forum.guild, role, to_add, to_remove, "AdForum Thread sync", max_edits)
+
+    @tasks.loop(seconds=1)
+    async def background_reconcile(self):
+        forums = []
+        for guild_id, guild_forums in self._forums.items():
+            guild = self.bot.get_guild(guild_id)
+            if not guild:
+                continue
+            for forum_id in guild_forums:
+                forum = guild.get_channel(forum_id)
+                if forum:
+                    forums.append(forum)
+
+        if not forums:
+            return
+
+        # spread the forums across the interval, to avoid bursts of requests
+        delay = await self.config.reconcile_interval() / len(forums)
+        edits_left = await self.config.reconcile_max_edits()
+        # the first cycle after loading is a full one, to pick up deletions from before
+        full = self.background_reconcile.current_loop % RECONCILE_FULL_CYCLES == 0
+        for forum in forums:
+            start = time.monotonic()
+            try:
+                edits = await self._sync_forum(forum, full = full, max_edits = edits_left)
+            except Exception:
+                # an error must not stop the loop, the forum is tried again in the next cycle
+                log.exception(f"Reconciling forum {forum.id} failed")
+                edits = 0
+            elapsed = time.monotonic() - start
+            edits_left = max(0, edits_left - edits)
+            log.info(f"Reconciled forum {forum.id} in guild {forum.guild.id} in {elapsed:.2f}s with {edits} role edits{' (full)' if full else ''}")
+
+            await asyncio.sleep(max(0, delay - elapsed))
 
     @commands.group()
     @commands.admin()
@@ -84,9 +278,10 @@ class AdForum(commands.Cog):
 
         forums[forum_id] = role.id
         await self.config.guild(ctx.guild).forums.set(forums)
+        self._cache_forums(ctx.guild.id, forums)
 
         async with ctx.typing():
-            await self._sync_forum(forum)
+            await self._sync_forum(forum, full = True)
         
         await ctx.send("The forum was setup and synced.")
         
@@ -104,13 +299,21 @@ class AdForum(commands.Cog):
         
         del forums[forum_id]
         await self.config.guild(ctx.guild).forums.set(forums)
+        self._cache_forums(ctx.guild.id, forums)
+        await self.config.guild(ctx.guild).threads.clear_raw(forum_id)
+        await self.config.guild(ctx.guild).archive_marks.clear_raw(forum_id)
+        self._threads.pop(forum.id, None)
         await ctx.send("The forum config was deleted.")
 
     @adforum.command()
     @commands.admin()
     @commands.guild_only()
-    async def sync(self, ctx: commands.Context, forum: discord.ForumChannel) -> None:
-        """Re-sync an Ad Forum channel"""
+    async def sync(self, ctx: commands.Context, forum: discord.ForumChannel, full: bool = False) -> None:
+        """Re-sync an Ad Forum channel
+
+        Only threads archived since the last sync are fetched, unless `full` is set.
+        Threads deleted while the bot was offline are only dropped by a full sync.
+        """
         forums = await self.config.guild(ctx.guild).forums()
         forum_id = str(forum.id)
         if forum_id not in forums:
@@ -118,37 +321,93 @@ class AdForum(commands.Cog):
             return
 
         async with ctx.typing():
-            await self._sync_forum(forum)
+            await self._sync_forum(forum, full)
 
         await ctx.send("The forum was synced.")
 
+    @commands.is_owner()
+    @adforum.command(name="setinterval")
+    async def set_interval(self, ctx: commands.Context, interval: int) -> None:
+        """Set the interval in seconds at which all forums are reconciled in the background
+
+        Forums are spread across the interval. 0 disables the background reconciliation, which is the default.
+
+        Each cycle fixes missing and extra roles, and picks up threads created or archived while the bot was offline.
+        Threads deleted while the bot was offline are only dropped every 24th cycle, which syncs all threads of the forums.
+        """
+        interval = max(0, interval)
+        await self.config.reconcile_interval.set(interval)
+        if interval:
+            self.background_reconcile.change_interval(seconds=interval)
+            if not self.background_reconcile.is_running():
+                self.background_reconcile.start()
+        else:
+            self.background_reconcile.cancel()
+        await ctx.send(f"Interval set to {interval}")
+
+    @commands.is_owner()
+    @adforum.command(name="setmaxedits")
+    async def set_max_edits(self, ctx: commands.Context, max_edits: int) -> None:
+        """Set how many role changes the background reconciliation makes per interval
+
+        Remaining changes are made in the following intervals. Default is 100.
+        """
+        await self.config.reconcile_max_edits.set(max(0, max_edits))
+        await ctx.send(f"Maximum role edits set to {await self.config.reconcile_max_edits()}")
+
     ### listeners
     @commands.Cog.listener()
     async def on_thread_create(self, thread: discord.Thread) -> None:
-        await self._process_thread(thread)
+        role_id = self._forums.get(thread.guild.id, {}).get(thread.parent_id)
+        if role_id is not None:
+            await self._process_thread(thread, role_id)
 
     @commands.Cog.listener()
     async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent) -> None:
-        forums = await self.config.guild_from_id(payload.guild_id).forums()
-        forum_id = str(payload.parent_id)
-        if forum_id in forums:
-            if payload.thread and payload.thread.owner:
-                await payload.thread.owner.remove_roles(payload.thread.guild.get_role(forums[forum_id]), reason = "AdForum Thread deleted")
-            else:
+        role_id = self._forums.get(payload.guild_id, {}).get(payload.parent_id)
+        if role_id is not None:
+            index = self._threads.get(payload.parent_id)
+            if index is None:
+                # not indexed yet, like during the startup sync, resync to build the index
                 guild = self.bot.get_guild(payload.guild_id)
-                await self._sync_forum(guild.get_channel(payload.parent_id))
+                forum = guild.get_channel(payload.parent_id) if guild else None
+                if forum:
+                    await self._sync_forum(forum, full = True)
+                return
+
+            owner_id = await self._unindex_thread(payload.guild_id, payload.parent_id, payload.thread_id)
+            if owner_id is None and payload.thread:
+                owner_id = payload.thread.owner_id
+
+            # the owner keeps the role while they have other threads in the forum
+            if owner_id is None or index.thread_count(owner_id):
+                return
+
+            guild = self.bot.get_guild(payload.guild_id)
+            owner = (await self._resolve_members(guild, [owner_id])).get(owner_id)
+            if owner:
+                await owner.remove_roles(guild.get_role(role_id), reason = "AdForum Thread deleted")
+
+    @commands.Cog.listener()
+    async def on_raw_thread_update(self, payload: discord.RawThreadUpdateEvent) -> None:
+        index = self._threads.get(payload.parent_id)
+        if index is None or payload.thread_id in index:
+            return
+
+        # a thread the index missed, like one created while the bot was offline
+        owner_id = payload.data.get("owner_id")
+        if owner_id:
+            await self._index_thread(payload.guild_id, payload.parent_id, payload.thread_id, int(owner_id))
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member) -> None:
-        forums = await self.config.guild_from_id(member.guild.id).forums()
-        for forum_id in forums:
-            role = member.guild.get_role(forums[forum_id])
-            forum_channel = member.guild.get_channel(int(forum_id))
-            if forum_channel:
-                for thread in forum_channel.threads:
-                    if thread.owner_id == member.id:
-                        await member.add_roles(role, reason = "AdForum Member Re-join")
-
-                async for thread in forum_channel.archived_threads(limit = None):
-                    if thread.owner_id == member.id:
-                        await member.add_roles(role, reason = "AdForum Member Re-join")
+        forums = self._forums.get(member.guild.id)
+        if not forums:
+            return
+
+        for forum_id, role_id in forums.items():
+            index = self._threads.get(forum_id)
+            if index and index.thread_count(member.id):
+                role = member.guild.get_role(role_id)
+                if role:
+                    await member.add_roles(role, reason = "AdForum Member Re-join")
@@ -0,0 +1,58 @@
+from typing import AbstractSet, Dict, KeysView, Optional, Set, Tuple
+
+
+class ForumThreadIndex:
+    """Threads of a forum by their owner
+
+    Keeps the owner of every thread, and the threads of every owner, so
+    owners can be looked up without going through the threads.
+    """
+
+    def __init__(self, threads: Optional[Dict[str, int]] = None):
+        self._owners: Dict[int, int] = {}
+        self._threads: Dict[int, Set[int]] = {}
+        # convert to int (ints cant be keys in json dicts)
+        for thread_id, owner_id in (threads or {}).items():
+            self.add(int(thread_id), owner_id)
+
+    def __contains__(self, thread_id: int) -> bool:
+        return thread_id in self._owners
+
+    def __len__(self) -> int:
+        return len(self._owners)
+
+    def owners(self) -> KeysView[int]:
+        """All members that own at least one thread"""
+        return self._threads.keys()
+
+    def owner(self, thread_id: int) -> Optional[int]:
+        """Get the owner of a thread"""
+        return self._owners.get(thread_id)
+
+    def thread_count(self, owner_id: int) -> int:
+        """Get the number of threads a member owns"""
+        return len(self._threads.get(owner_id, ()))
+
+    def add(self, thread_id: int, owner_id: int) -> None:
+        """Add a thread, or update its owner"""
+        self.remove(thread_id)
+        self._owners[thread_id] = owner_id
+        self._threads.setdefault(owner_id, set()).add(thread_id)
+
+    def remove(self, thread_id: int) -> Optional[int]:
+        """Remove a thread, returns its owner"""
+        owner_id = self._owners.pop(thread_id, None)
+        if owner_id is not None:
+            threads = self._threads[owner_id]
+            threads.discard(thread_id)
+            if not threads:
+                del self._threads[owner_id]
+        return owner_id
+
+    def to_config(self) -> Dict[str, int]:
+        return {str(thread_id): owner_id for thread_id, owner_id in self._owners.items()}
+
+
+def diff_role_members(owner_ids: AbstractSet[int], role_member_ids: AbstractSet[int]) -> Tuple[Set[int], Set[int]]:
+    """Compute the members that need the role added, and the members that need it removed"""
+    return set(owner_ids - role_member_ids), set(role_member_ids - owner_ids)
@@ -23,6 +23,9 @@ class CFModTracker(commands.Cog):
 
     has_warned_about_invalid_channels = False
 
+    # base URL of the CurseForge API, can be pointed at a local stand-in for testing
+    api_base = "https://api.curseforge.com"
+
     def __init__(self, bot: bot.Red):
         self.bot = bot
         self.conf = Config.get_conf(self, identifier=923552983512876, force_registration=True)
@@ -252,7 +255,7 @@ class CFModTracker(commands.Cog):
         return hashlib.sha256(canonicalString.encode()).hexdigest()
 
     async def get_json(self, modId, api_key):
-        r = requests.get(f"https://api.curseforge.com/v1/mods/{modId}", headers={'X-Api-Key': api_key})
+        r = requests.get(f"{self.api_base}/v1/mods/{modId}", headers={'X-Api-Key': api_key})
         if r.status_code == 200:
             try:
                 json = r.json()
@@ -263,7 +266,7 @@ class CFModTracker(commands.Cog):
         return None
 
     async def get_changelog(self, modId, fileId, api_key):
-        r = requests.get(f"https://api.curseforge.com/v1/mods/{modId}/files/{fileId}/changelog", headers={'X-Api-Key': api_key})
+        r = requests.get(f"{self.api_base}/v1/mods/{modId}/files/{fileId}/changelog", headers={'X-Api-Key': api_key})
         if r.status_code == 200:
             json = r.json()
             if json and isinstance(json, dict):
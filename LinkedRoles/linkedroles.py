@@ -1,13 +1,56 @@
-from typing import Any
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+import asyncio
 import discord
 import logging
+import time
+import weakref
 
+from discord.ext import tasks
 from redbot.core import Config
 from redbot.core import commands
+from redbot.core.utils.chat_formatting import pagify
+
+from .roles import LinkedRoleIndex, plan_guild_roles, plan_member_roles
 
 log = logging.getLogger("red.nevcairiel.linkedroles")
 
+# members processed between checkpoints
+UPDATE_CHUNK_SIZE = 100
+# members of a chunk processed at once, the checkpoint is only
+# saved after the whole chunk is done
+UPDATE_CONCURRENCY = 4
+# seconds to wait for more role updates of a member before processing them
+COALESCE_DELAY = 1.0
+# seconds between chunks of the startup reconciliation, it runs alongside normal operation
+RECONCILE_CHUNK_DELAY = 1.0
+
+class MemberUpdateJob:
+    """Progress of processing all members of a guild in the background"""
+
+    def __init__(self, guild: discord.Guild, members: List[discord.Member], channel: Optional[discord.abc.Messageable], resumable: bool = True, delay: float = 0):
+        self.guild = guild
+        self.members = members
+        self.channel = channel
+        # save checkpoints, so an interrupted job can be resumed
+        self.resumable = resumable
+        # seconds to wait between chunks
+        self.delay = delay
+        self.processed = 0
+        self.changed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def total(self) -> int:
+        return len(self.members)
+
+    def progress(self) -> str:
+        elapsed = int(time.monotonic() - self.started)
+        return (f"Processed {self.processed} of {self.total} members in {elapsed}s, "
+                f"{self.changed} had their roles updated, {self.failed} failed")
+
 class LinkedRoles(commands.Cog):
     """Linked Roles Cog"""
 
@@ -21,6 +64,7 @@ class LinkedRoles(commands.Cog):
         # default global settings
         default_guild = {
             "linked_roles": {},
+            "update_checkpoint": 0,
         }
         self.config.register_guild(**default_guild)
 
@@ -29,10 +73,123 @@ class LinkedRoles(commands.Cog):
         }
         self.config.register_member(**default_member)
 
+        # linked role configuration per guild, only configured guilds are present
+        self._indexes: Dict[int, LinkedRoleIndex] = {}
+
+        # background member updates per guild
+        self._jobs: Dict[int, MemberUpdateJob] = {}
+
+        # stored roles per guild and member, loaded on first use and written in batches
+        self._stored_roles: Dict[int, Dict[int, List[int]]] = {}
+        self._stored_roles_dirty: Dict[int, Set[int]] = {}
+        self._stored_roles_locks: Dict[int, asyncio.Lock] = {}
+
+        # role update bursts per member, waiting to be processed
+        self._pending_updates: Dict[Tuple[int, int], Set[int]] = {}
+        self._pending_tasks: Dict[Tuple[int, int], asyncio.Task] = {}
+        # serializes processing of each member, the locks go away once nobody holds them
+        self._member_locks: "weakref.WeakValueDictionary[Tuple[int, int], asyncio.Lock]" = weakref.WeakValueDictionary()
+
+        self._reconcile_task: Optional[asyncio.Task] = None
+
+    async def cog_load(self) -> None:
+        all_guilds = await self.config.all_guilds()
+        for guild_id, data in all_guilds.items():
+            self._update_index(guild_id, data["linked_roles"])
+
+        self.background_flush_stored_roles.start()
+        self._reconcile_task = asyncio.create_task(self._reconcile())
+
+    async def cog_unload(self) -> None:
+        if self._reconcile_task:
+            self._reconcile_task.cancel()
+
+        # the checkpoints are kept, so the jobs can be resumed
+        for job in self._jobs.values():
+            job.task.cancel()
+
+        for task in self._pending_tasks.values():
+            task.cancel()
+
+        self.background_flush_stored_roles.cancel()
+        await self._flush_stored_roles()
+
+    def _update_index(self, guild_id: int, linked_roles: dict) -> None:
+        """Rebuild the cached index of a guild, after its linked roles changed"""
+        index = LinkedRoleIndex(linked_roles)
+        if index:
+            self._indexes[guild_id] = index
+        else:
+            self._indexes.pop(guild_id, None)
+
     async def red_delete_data_for_user(self, *, requester: Any, user_id: int):
         """Method for finding users data inside the cog and deleting it."""
         for guild in self.bot.guilds:
-            await self.config.member_from_ids(guild.id, user_id).clear()
+            await self._clear_stored_roles(guild.id, user_id)
+
+    ### stored roles
+    async def _get_stored_roles(self, guild: discord.Guild) -> Dict[int, List[int]]:
+        """Get the stored roles of all members of a guild, loading them on first use"""
+        stored_roles = self._stored_roles.get(guild.id)
+        if stored_roles is not None:
+            return stored_roles
+
+        async with self._stored_roles_locks.setdefault(guild.id, asyncio.Lock()):
+            if guild.id not in self._stored_roles:
+                members = await self.config.all_members(guild)
+                self._stored_roles[guild.id] = {member_id: data["stored_roles"] for member_id, data in members.items() if data["stored_roles"]}
+
+        return self._stored_roles[guild.id]
+
+    def _set_stored_roles(self, guild: discord.Guild, member_id: int, roles: List[int]) -> None:
+        """Update the stored roles of a member, they are written with the next flush"""
+        stored_roles = self._stored_roles[guild.id]
+        if roles:
+            stored_roles[member_id] = roles
+        else:
+            stored_roles.pop(member_id, None)
+        self._stored_roles_dirty.setdefault(guild.id, set()).add(member_id)
+
+    async def _clear_stored_roles(self, guild_id: int, member_id: int) -> None:
+        """Forget the stored roles of a member, through the cache if the guild is loaded"""
+        # the lock keeps this from racing with the guild being loaded
+        async with self._stored_roles_locks.setdefault(guild_id, asyncio.Lock()):
+            stored_roles = self._stored_roles.get(guild_id)
+            if stored_roles is None:
+                await self.config.member_from_ids(guild_id, member_id).stored_roles.clear()
+                return
+
+        if stored_roles.pop(member_id, None) is not None:
+            self._stored_roles_dirty.setdefault(guild_id, set()).add(member_id)
+
+    async def _flush_stored_roles(self, guild_id: Optional[int] = None) -> None:
+        """Write the stored roles of all changed members"""
+        guild_ids = [guild_id] if guild_id is not None else list(self._stored_roles_dirty)
+        for guild_id in guild_ids:
+            dirty = self._stored_roles_dirty.pop(guild_id, None)
+            if not dirty:
+                continue
+
+            # always write the latest roles, members changed while writing are dirty again
+            stored_roles = self._stored_roles[guild_id]
+            try:
+                for member_id in dirty:
+                    roles = stored_roles.get(member_id)
+                    if roles:
+                        await self.config.member_from_ids(guild_id, member_id).stored_roles.set(roles)
+                    else:
+                        await self.config.member_from_ids(guild_id, member_id).stored_roles.clear()
+            except Exception:
+                # try again with the next flush
+                self._stored_roles_dirty.setdefault(guild_id, set()).update(dirty)
+                raise
+
+    @tasks.loop(seconds=10)
+    async def background_flush_stored_roles(self):
+        try:
+            await self._flush_stored_roles()
+        except Exception:
+            log.exception("Saving stored roles failed")
 
     @commands.group()
     @commands.admin()
@@ -63,6 +220,7 @@ class LinkedRoles(commands.Cog):
             
         linked_roles[role_id] = []
         await self.config.guild(ctx.guild).linked_roles.set(linked_roles)
+        self._update_index(ctx.guild.id, linked_roles)
         await ctx.send(f"Role {role} has been setup as a linked role. Add reference roles with {ctx.prefix}linkedroles addrole now.")
 
     @linkedroles.command()
@@ -75,13 +233,15 @@ class LinkedRoles(commands.Cog):
         if role_id in linked_roles:
             del linked_roles[role_id]
             await self.config.guild(ctx.guild).linked_roles.set(linked_roles)
+            self._update_index(ctx.guild.id, linked_roles)
 
             # remove stored roles from all members
-            members = await self.config.all_members(ctx.guild)
-            for member_id, data in members.items():
-                data["stored_roles"].remove(role.id)
-                await self.config.member_from_ids(ctx.guild.id, member_id).set(data)
-            
+            stored_roles = await self._get_stored_roles(ctx.guild)
+            for member_id, roles in list(stored_roles.items()):
+                if role.id in roles:
+                    self._set_stored_roles(ctx.guild, member_id, [role_id for role_id in roles if role_id != role.id])
+            await self._flush_stored_roles(ctx.guild.id)
+
             await ctx.send(f"Role {role} has been removed as a linked role")
             return
         
@@ -104,6 +264,7 @@ class LinkedRoles(commands.Cog):
                 return
             linked_roles[role_id].append(refrole.id)
             await self.config.guild(ctx.guild).linked_roles.set(linked_roles)
+            self._update_index(ctx.guild.id, linked_roles)
             await ctx.send(f"Role {refrole} has been added as a reference for {linkedrole}")
             return
             
@@ -126,6 +287,7 @@ class LinkedRoles(commands.Cog):
                 return
             linked_roles[role_id].remove(refrole.id)
             await self.config.guild(ctx.guild).linked_roles.set(linked_roles)
+            self._update_index(ctx.guild.id, linked_roles)
             await ctx.send(f"Role {refrole} has been removed as a reference for {linkedrole}")
             return
             
@@ -134,75 +296,244 @@ class LinkedRoles(commands.Cog):
     @linkedroles.command()
     @commands.admin()
     @commands.guild_only()
-    async def updatemembers(self, ctx: commands.Context) -> None:
-        """"Process all members after changing the linked role configuration"""
-        member_count = 0
-        async with ctx.typing():
-            for member in ctx.guild.members:
-                await self._process_member(member)
-
-            members = await self.config.all_members(ctx.guild)
-            for member_id, data in members.items():
-                if data["stored_roles"]:
-                    member_count += 1
-        
-        await ctx.send(f"There is now {member_count} members with a saved role")
+    async def plan(self, ctx: commands.Context) -> None:
+        """Show the role changes processing all members would make, without making them
 
-    async def _process_member(self, member: discord.Member) -> None:
-        """Process the provided member for linked role changes, if needed"""
-        # load config for this guild
-        linked_roles = await self.config.guild(member.guild).linked_roles()
-        if not linked_roles:
+        Example:
+        `[p]linkedroles plan`
+        """
+        index = self._indexes.get(ctx.guild.id)
+        if not index:
+            await ctx.send("No linked roles are setup.")
             return
-        
-        # iterate over all configured roles
-        for role_id, ref_roles in linked_roles.items():
-            if not ref_roles:
+
+        stored_roles = await self._get_stored_roles(ctx.guild)
+        members = ((member.id, {role.id for role in member.roles}) for member in ctx.guild.members)
+        plan = plan_guild_roles(index, members, stored_roles, {role.id for role in ctx.guild.roles})
+
+        message = (f"Processing {plan.members} members would update the roles of {plan.edits} members, one request each, "
+                   f"and change the saved roles of {plan.stored} members")
+        for role_id in sorted(plan.added.keys() | plan.removed.keys()):
+            role = ctx.guild.get_role(role_id)
+            message += f"\n{role.name if role else role_id}: {plan.added[role_id]} added, {plan.removed[role_id]} removed"
+
+        for page in pagify(message):
+            await ctx.send(page)
+
+    @linkedroles.command()
+    @commands.admin()
+    @commands.guild_only()
+    async def updatemembers(self, ctx: commands.Context, restart: bool = False) -> None:
+        """"Process all members after changing the linked role configuration
+
+        Members are processed in the background. If a previous run was cancelled or
+        interrupted, it continues where it stopped, unless `restart` is set.
+
+        Example:
+        `[p]linkedroles updatemembers`
+        `[p]linkedroles updatemembers true`
+        """
+        job = self._jobs.get(ctx.guild.id)
+        if job:
+            await ctx.send(f"An update is already running. {job.progress()}")
+            return
+
+        checkpoint = 0
+        if restart:
+            await self.config.guild(ctx.guild).update_checkpoint.set(0)
+        else:
+            checkpoint = await self.config.guild(ctx.guild).update_checkpoint()
+
+        # process in member ID order, so the checkpoint is meaningful
+        members = sorted((member for member in ctx.guild.members if member.id > checkpoint), key=lambda member: member.id)
+        job = self._start_job(ctx.guild, members, ctx.channel)
+        if checkpoint:
+            await ctx.send(f"Resuming the update with {job.total} remaining members. Check the progress with {ctx.prefix}linkedroles updatestatus")
+        else:
+            await ctx.send(f"Updating {job.total} members. Check the progress with {ctx.prefix}linkedroles updatestatus")
+
+    @linkedroles.command()
+    @commands.admin()
+    @commands.guild_only()
+    async def updatestatus(self, ctx: commands.Context) -> None:
+        """Show the progress of a running member update"""
+        job = self._jobs.get(ctx.guild.id)
+        if not job:
+            await ctx.send("No update is running.")
+            return
+
+        await ctx.send(job.progress())
+
+    @linkedroles.command()
+    @commands.admin()
+    @commands.guild_only()
+    async def updatecancel(self, ctx: commands.Context) -> None:
+        """Cancel a running member update, it can be resumed later"""
+        job = self._jobs.get(ctx.guild.id)
+        if not job:
+            await ctx.send("No update is running.")
+            return
+
+        job.task.cancel()
+        await ctx.send(f"The update was cancelled. {job.progress()}")
+
+    def _start_job(self, guild: discord.Guild, members: List[discord.Member], channel: Optional[discord.abc.Messageable] = None, **kwargs) -> MemberUpdateJob:
+        job = MemberUpdateJob(guild, members, channel, **kwargs)
+        job.task = asyncio.create_task(self._run_job(job))
+        self._jobs[guild.id] = job
+        return job
+
+    async def _run_job(self, job: MemberUpdateJob) -> None:
+        """Process the members of a job in chunks, saving a checkpoint after each chunk"""
+        semaphore = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+        async def process(member: discord.Member) -> None:
+            async with semaphore:
+                try:
+                    if await self._process_member(member):
+                        job.changed += 1
+                except discord.HTTPException:
+                    job.failed += 1
+                    log.exception(f"Updating linked roles of member {member.id} failed")
+                job.processed += 1
+
+        try:
+            for start in range(0, job.total, UPDATE_CHUNK_SIZE):
+                chunk = job.members[start:start + UPDATE_CHUNK_SIZE]
+                # members may have left since the job was started
+                await asyncio.gather(*(process(member) for member in chunk if job.guild.get_member(member.id)))
+                if job.resumable:
+                    await self.config.guild(job.guild).update_checkpoint.set(chunk[-1].id)
+                if job.delay:
+                    await asyncio.sleep(job.delay)
+
+            if job.resumable:
+                await self.config.guild(job.guild).update_checkpoint.set(0)
+        except asyncio.CancelledError:
+            log.info(f"Member update in guild {job.guild.id} cancelled. {job.progress()}")
+            raise
+        finally:
+            del self._jobs[job.guild.id]
+
+        log.info(f"Member update in guild {job.guild.id} finished. {job.progress()}")
+        if job.channel:
+            member_count = len(await self._get_stored_roles(job.guild))
+
+            try:
+                await job.channel.send(f"The member update finished. {job.progress()}\nThere is now {member_count} members with a saved role")
+            except discord.HTTPException:
+                pass
+
+    async def _reconcile(self) -> None:
+        """Process members whose roles may have changed while the bot was offline
+
+        Only members with a linked or reference role can need changes, the guilds
+        are processed one after another, in small chunks.
+        """
+        await self.bot.wait_until_red_ready()
+
+        for guild_id, index in list(self._indexes.items()):
+            guild = self.bot.get_guild(guild_id)
+            if not guild or guild_id in self._jobs:
                 continue
 
-            # convert to int (ints cant be keys in json dicts)
-            role_id = int(role_id)
+            members: Dict[int, discord.Member] = {}
+            for role_id in index.affected:
+                role = guild.get_role(role_id)
+                if role:
+                    members.update((member.id, member) for member in role.members)
 
-            # check if the user has the configured role
-            role = member.get_role(role_id)
+            if not members:
+                continue
 
-            # check if the user has any of the ref roles
-            has_ref_role = False
-            for ref_role_id in ref_roles:
-                if member.get_role(ref_role_id):
-                    has_ref_role = True
-                    break
-            
-            # if the user has the role, check if we need to save it and remove it
-            if role:
-                if not has_ref_role:
-                    async with self.config.member(member).stored_roles() as stored_roles:
-                        if role_id not in stored_roles:
-                            stored_roles.append(role_id)
-                    await member.remove_roles(role, reason="Saving Linked Role")
-            else:
-                # or check if we need to re-add the role
-                if has_ref_role:
-                    # lookup the role from the guild, we need it below
-                    role = member.guild.get_role(role_id)
-                    if not role: # sanity check
-                        return
-
-                    # if we have the reference role, check our storage if we previously saved the role
-                    stored_roles = await self.config.member(member).stored_roles()
-                    if role_id in stored_roles:
-                        # remove the role from storage so that the bot won't reapply it constantly
-                        # this allows self-service actions to change the role
-                        stored_roles.remove(role_id)
-                        await self.config.member(member).stored_roles.set(stored_roles)
-                        # and finally, add the role to the user
-                        await member.add_roles(role, reason="Restoring Linked Role")
+            log.info(f"Reconciling linked roles of {len(members)} members in guild {guild_id}")
+            job = self._start_job(guild, list(members.values()), resumable=False, delay=RECONCILE_CHUNK_DELAY)
+            # wait without raising if the job is cancelled
+            await asyncio.wait([job.task])
+
+    async def _process_member(self, member: discord.Member, linked_role_ids: Optional[Set[int]] = None) -> bool:
+        """Process the provided member for linked role changes, if needed
+
+        If `linked_role_ids` is specified, only those linked roles are checked.
+        Returns if the roles of the member were changed.
+        """
+        lock = self._member_locks.setdefault((member.guild.id, member.id), asyncio.Lock())
+        async with lock:
+            # the member may have changed while waiting for the lock, use the latest state
+            member = member.guild.get_member(member.id) or member
+            return await self._process_member_locked(member, linked_role_ids)
+
+    async def _process_member_locked(self, member: discord.Member, linked_role_ids: Optional[Set[int]]) -> bool:
+        index = self._indexes.get(member.guild.id)
+        if not index:
+            return False
+
+        linked_roles = index.subset(linked_role_ids)
+        if not linked_roles:
+            return False
+
+        # without any linked or reference role there is nothing to save or restore
+        member_roles = {role.id for role in member.roles}
+        if index.affected.keys().isdisjoint(member_roles):
+            return False
+
+        stored_roles = (await self._get_stored_roles(member.guild)).get(member.id, [])
+        to_add, to_remove, new_stored_roles = plan_member_roles(member_roles, linked_roles, stored_roles)
+
+        # only restore roles that still exist
+        to_add = {role_id for role_id in to_add if member.guild.get_role(role_id)}
+
+        # update the storage before touching the roles
+        if new_stored_roles != stored_roles:
+            self._set_stored_roles(member.guild, member.id, new_stored_roles)
+
+        # apply all role changes in a single edit
+        if to_add or to_remove:
+            roles = [role for role in member.roles if not role.is_default() and role.id not in to_remove]
+            roles += [member.guild.get_role(role_id) for role_id in to_add]
+            await member.edit(roles=roles, reason="Updating Linked Roles")
+            return True
+
+        return False
 
     ### listeners
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
-        await self._process_member(after)
+        index = self._indexes.get(after.guild.id)
+        if not index:
+            return
+
+        # only the linked roles depending on roles that changed need to be checked
+        changed_roles = {role.id for role in before.roles} ^ {role.id for role in after.roles}
+        if not changed_roles:
+            return
+
+        linked_role_ids = index.affected_by(changed_roles)
+        if not linked_role_ids:
+            return
+
+        # coalesce bursts of updates, they are processed together once they settle
+        key = (after.guild.id, after.id)
+        self._pending_updates.setdefault(key, set()).update(linked_role_ids)
+        if key not in self._pending_tasks:
+            self._pending_tasks[key] = asyncio.create_task(self._process_pending(after.guild, after.id))
+
+    async def _process_pending(self, guild: discord.Guild, member_id: int) -> None:
+        key = (guild.id, member_id)
+        try:
+            await asyncio.sleep(COALESCE_DELAY)
+        finally:
+            # updates from here on start a new burst
+            del self._pending_tasks[key]
+        linked_role_ids = self._pending_updates.pop(key, None)
+
+        member = guild.get_member(member_id)
+        if member and linked_role_ids:
+            try:
+                await self._process_member(member, linked_role_ids)
+            except discord.HTTPException:
+                log.exception(f"Updating linked roles of member {member_id} failed")
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member) -> None:
-        await self.config.member(member).clear()
+        await self._clear_stored_roles(member.guild.id, member.id)
@@ -0,0 +1,109 @@
+from collections import Counter
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+
+class LinkedRoleIndex:
+    """Linked role configuration of a guild, with a reverse index
+
+    Maps every role to the linked roles it can affect, which are the linked
+    roles it is a reference for, and the linked role itself.
+    """
+
+    def __init__(self, linked_roles: Dict[str, List[int]]):
+        # convert to int (ints cant be keys in json dicts)
+        self.linked: Dict[int, FrozenSet[int]] = {int(role_id): frozenset(ref_roles) for role_id, ref_roles in linked_roles.items()}
+        self.affected: Dict[int, Set[int]] = {}
+        for role_id, ref_roles in self.linked.items():
+            if not ref_roles:
+                continue
+            self.affected.setdefault(role_id, set()).add(role_id)
+            for ref_role_id in ref_roles:
+                self.affected.setdefault(ref_role_id, set()).add(role_id)
+
+    def __bool__(self) -> bool:
+        return bool(self.affected)
+
+    def affected_by(self, role_ids: Iterable[int]) -> Set[int]:
+        """Get all linked roles that depend on any of the given roles"""
+        linked = set()
+        for role_id in role_ids:
+            linked.update(self.affected.get(role_id, ()))
+        return linked
+
+    def subset(self, linked_role_ids: Optional[Iterable[int]] = None) -> Dict[int, FrozenSet[int]]:
+        """Get the reference roles of the given linked roles, or all of them"""
+        if linked_role_ids is None:
+            return self.linked
+        return {role_id: self.linked[role_id] for role_id in linked_role_ids if role_id in self.linked}
+
+
+def plan_member_roles(member_roles: Set[int], linked_roles: Dict[int, Iterable[int]], stored_roles: List[int]) -> Tuple[Set[int], Set[int], List[int]]:
+    """Compute the linked role changes for a member
+
+    Returns the role IDs to add, the role IDs to remove and the new list of stored roles
+    """
+    to_add = set()
+    to_remove = set()
+    stored = list(stored_roles)
+    for role_id, ref_roles in linked_roles.items():
+        if not ref_roles:
+            continue
+
+        has_ref_role = not member_roles.isdisjoint(ref_roles)
+
+        # if the user has the role, check if we need to save it and remove it
+        if role_id in member_roles:
+            if not has_ref_role:
+                if role_id not in stored:
+                    stored.append(role_id)
+                to_remove.add(role_id)
+        # or check if we need to re-add the role, if it was previously saved
+        # the role is removed from storage so that the bot won't reapply it constantly,
+        # this allows self-service actions to change the role
+        elif has_ref_role and role_id in stored:
+            stored.remove(role_id)
+            to_add.add(role_id)
+
+    return to_add, to_remove, stored
+
+
+class RolePlan:
+    """Summary of the linked role changes for all members of a guild, without applying them"""
+
+    def __init__(self):
+        self.members = 0
+        # members whose roles change, each is one role edit
+        self.edits = 0
+        # members whose stored roles change
+        self.stored = 0
+        self.added: Counter = Counter()
+        self.removed: Counter = Counter()
+
+
+def plan_guild_roles(index: LinkedRoleIndex, members: Iterable[Tuple[int, Set[int]]], stored_roles: Dict[int, List[int]], existing_roles: Optional[Set[int]] = None) -> RolePlan:
+    """Compute the linked role changes for all members, from member IDs and their role IDs
+
+    Stored roles are not modified. If `existing_roles` is specified, roles that
+    no longer exist are not counted as added, the same as when processing members.
+    """
+    plan = RolePlan()
+    relevant = index.affected.keys()
+    for member_id, member_roles in members:
+        plan.members += 1
+        # without any linked or reference role there is nothing to save or restore
+        if relevant.isdisjoint(member_roles):
+            continue
+
+        stored = stored_roles.get(member_id, [])
+        to_add, to_remove, new_stored = plan_member_roles(member_roles, index.linked, stored)
+        if existing_roles is not None:
+            to_add &= existing_roles
+
+        if new_stored != stored:
+            plan.stored += 1
+        if to_add or to_remove:
+            plan.edits += 1
+            plan.added.update(to_add)
+            plan.removed.update(to_remove)
+
+    return plan
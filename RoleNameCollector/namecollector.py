@@ -1,4 +1,5 @@
 from abc import ABC
+from typing import Dict
 
 import discord
 import logging
@@ -26,12 +27,18 @@ class RoleNameCollector(commands.Cog, metaclass=CompositeMetaClass):
         self.bot = bot
         self.config = Config.get_conf(self, identifier=253523432)
 
+        # display names of the members with the role per guild, in list order, loaded on first use
+        self._names: Dict[int, Dict[int, str]] = {}
+        # contents last written to the user list file per guild
+        self._written: Dict[int, bytes] = {}
+
     async def user_whitelisted(self, user: discord.Member) -> bool:
         """Check if a user has a whitelisted role"""
         guildrole = await self.config.guild(user.guild).role()
         return user.get_role(guildrole) is not None
     
-    async def update_userlist(self, guild: discord.Guild):
+    async def update_userlist(self, guild: discord.Guild, force: bool = False):
+        """Rebuild the name list from the role members, and write it if it changed"""
         userlist_file = await self.config.guild(guild).userlist_file()
         if not userlist_file:
             return
@@ -44,25 +51,46 @@ class RoleNameCollector(commands.Cog, metaclass=CompositeMetaClass):
         if not guildrole:
             return
 
-        userlist = []
-
         # collect all users
-        for member in guildrole.members:
-            if not member:
-                continue
+        self._names[guild.id] = {member.id: member.display_name for member in guildrole.members if member}
+        self.write_userlist(guild, userlist_file, force)
 
-            userlist.append(member.display_name)
+    def write_userlist(self, guild: discord.Guild, filename: str, force: bool = False):
+        """Write the name list of a guild, unless the file already has the same contents"""
+        data = bytes('\n'.join(self._names[guild.id].values()) + '\n', "utf-8")
+        if not force and self._written.get(guild.id) == data:
+            return
 
-        filename = userlist_file
         filename_tmp = filename + ".tmp"
         try:
-            with open(filename + ".tmp", "wb") as file:
-                file.write(bytes('\n'.join(userlist) + '\n', "utf-8"))
+            with open(filename_tmp, "wb") as file:
+                file.write(data)
 
             os.replace(filename_tmp, filename)
+            self._written[guild.id] = data
         except Exception as e:
             log.error(e)
 
+    async def update_member(self, member: discord.Member, has_role: bool):
+        """Add, rename or remove a single member in the name list"""
+        guild = member.guild
+        if guild.id not in self._names:
+            # the first change in this guild builds the full list
+            await self.update_userlist(guild)
+            return
+
+        userlist_file = await self.config.guild(guild).userlist_file()
+        if not userlist_file:
+            return
+
+        names = self._names[guild.id]
+        if has_role:
+            names[member.id] = member.display_name
+        elif names.pop(member.id, None) is None:
+            return
+
+        self.write_userlist(guild, userlist_file)
+
     async def update_all_guilds_for_member(self, user: discord.User):
         """Update all guilds a user is a member of"""
         all_guilds = await self.config.all_guilds()
@@ -103,13 +131,14 @@ class RoleNameCollector(commands.Cog, metaclass=CompositeMetaClass):
     async def setrole(self, ctx: commands.Context, role: discord.Role):
         """Set the role for the Role Name Collector"""
         await self.config.guild(ctx.guild).role.set(role.id)
+        self._names.pop(ctx.guild.id, None)
         await ctx.send(f"The role {role.mention} has been set. Remember to sync to apply changes.", delete_after=4)
 
     @rolenamecollector.command(name = "sync")
     @commands.is_owner()
     async def sync_userlist(self, ctx: commands.Context):
         """Re-sync the name list to disk"""
-        await self.update_userlist(ctx.guild)
+        await self.update_userlist(ctx.guild, force = True)
         await ctx.send("The userlist was synced.", delete_after=4)
 
     @rolenamecollector.group(name = "set")
@@ -125,6 +154,7 @@ class RoleNameCollector(commands.Cog, metaclass=CompositeMetaClass):
         try:
             with open(filename, "wb") as file:
                 await self.config.guild(ctx.guild).userlist_file.set(filename)
+                self._written.pop(ctx.guild.id, None)
                 await ctx.send("User file set.", delete_after=4)
         except:
             await ctx.send("Specified file is not accessible.", delete_after=4)
@@ -132,15 +162,33 @@ class RoleNameCollector(commands.Cog, metaclass=CompositeMetaClass):
     ### listeners
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
-        guild = after.guild
+        guildrole = await self.config.guild(after.guild).role()
+        if not guildrole:
+            return
 
-        was_member = await self.user_whitelisted(before)
-        is_member = await self.user_whitelisted(after)
+        was_member = before.get_role(guildrole) is not None
+        is_member = after.get_role(guildrole) is not None
 
-        if was_member != is_member:
-            await self.update_userlist(guild)
+        # renames only matter for members with the role
+        if was_member != is_member or (is_member and before.display_name != after.display_name):
+            await self.update_member(after, is_member)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User) -> None:
+        if before.display_name == after.display_name:
+            return
+
+        # members without a nickname are listed with their global name
+        for guild_id, names in list(self._names.items()):
+            if after.id not in names:
+                continue
+
+            guild = self.bot.get_guild(guild_id)
+            member = guild.get_member(after.id) if guild else None
+            if member:
+                await self.update_member(member, True)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member) -> None:
         if await self.user_whitelisted(member):
-            await self.update_userlist(member.guild)
+            await self.update_member(member, False)
@@ -0,0 +1,126 @@
+from abc import ABC, abstractmethod
+from typing import Dict, FrozenSet, List, Type
+
+import aiohttp
+import asyncio
+import json
+import time
+
+from .whitelist import render_whitelist, write_file_atomic
+
+
+class WhitelistUpdate:
+    """A new version of a guild whitelist, and how it differs from the previous one"""
+
+    __slots__ = ("guild_id", "sequence", "entries", "added", "removed", "reset")
+
+    def __init__(self, guild_id: int, sequence: int, entries: List[str], added: FrozenSet[str], removed: FrozenSet[str], reset: bool = False):
+        self.guild_id = guild_id
+        self.sequence = sequence
+        self.entries = entries
+        self.added = added
+        self.removed = removed
+        # the previous contents are unknown, consumers should replace their list with the added IDs
+        self.reset = reset
+
+    def delta(self) -> dict:
+        return {
+            "guild": self.guild_id,
+            "sequence": self.sequence,
+            "time": int(time.time()),
+            "added": sorted(self.added),
+            "removed": sorted(self.removed),
+            "reset": self.reset,
+        }
+
+
+class WhitelistSink(ABC):
+    """Output target for a guild whitelist"""
+
+    # set if the target is a file, which is tested for access when added
+    is_file = False
+
+    def __init__(self, target: str):
+        self.target = target
+
+    @staticmethod
+    def validate(target: str) -> bool:
+        return bool(target)
+
+    @abstractmethod
+    async def write(self, update: WhitelistUpdate) -> None:
+        pass
+
+    async def _run_blocking(self, func, *args) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+class TextFileSink(WhitelistSink):
+    """Newline-separated list of all Steam IDs"""
+
+    is_file = True
+
+    async def write(self, update: WhitelistUpdate) -> None:
+        await self._run_blocking(write_file_atomic, self.target, render_whitelist(update.entries))
+
+
+class JSONFileSink(WhitelistSink):
+    """JSON document with all Steam IDs and the sequence number"""
+
+    is_file = True
+
+    async def write(self, update: WhitelistUpdate) -> None:
+        data = json.dumps({"sequence": update.sequence, "whitelist": update.entries})
+        await self._run_blocking(write_file_atomic, self.target, bytes(data, "utf-8"))
+
+
+class DeltaLogSink(WhitelistSink):
+    """Append-only log with one JSON line of added and removed Steam IDs per update"""
+
+    is_file = True
+
+    @staticmethod
+    def _append(filename: str, data: bytes) -> None:
+        with open(filename, "ab") as file:
+            file.write(data)
+
+    async def write(self, update: WhitelistUpdate) -> None:
+        data = json.dumps(update.delta()) + "\n"
+        await self._run_blocking(self._append, self.target, bytes(data, "utf-8"))
+
+
+class HTTPSink(WhitelistSink):
+    """POST the changes as JSON to an HTTP endpoint"""
+
+    timeout = aiohttp.ClientTimeout(total=10)
+
+    @staticmethod
+    def validate(target: str) -> bool:
+        return target.startswith("http://") or target.startswith("https://")
+
+    async def write(self, update: WhitelistUpdate) -> None:
+        async with aiohttp.ClientSession(timeout=self.timeout) as session:
+            async with session.post(self.target, json=update.delta()) as response:
+                response.raise_for_status()
+
+
+class UnixSocketSink(WhitelistSink):
+    """Send the changes as a JSON line to a Unix socket"""
+
+    async def write(self, update: WhitelistUpdate) -> None:
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.target), timeout=10)
+        try:
+            writer.write(bytes(json.dumps(update.delta()) + "\n", "utf-8"))
+            await writer.drain()
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+
+SINK_TYPES: Dict[str, Type[WhitelistSink]] = {
+    "text": TextFileSink,
+    "json": JSONFileSink,
+    "delta": DeltaLogSink,
+    "http": HTTPSink,
+    "unix": UnixSocketSink,
+}
@@ -1,15 +1,24 @@
 from abc import ABC
-from typing import Literal
+from typing import Dict, List, Literal, Optional, Tuple
 
+import asyncio
 import discord
 import logging
-import os
 import re
+import time
 from redbot.core import Config
 from redbot.core import commands, app_commands
 
+from redbot.core.utils.chat_formatting import pagify
+
+from .sinks import SINK_TYPES, TextFileSink, WhitelistSink, WhitelistUpdate
+from .whitelist import GuildSettings, GuildWhitelist, SteamIDIndex, hash_whitelist
+
 log = logging.getLogger("nevcairiel.SteamWhitelist")
 
+STEAMID_REGEX = re.compile(r"76561[0-9]{12}")
+STEAMID_SEPARATOR = re.compile(r"[\s,;]+")
+
 class CompositeMetaClass(type(commands.Cog), type(ABC)):
     """
     This allows the metaclass used for proper type detection to
@@ -50,7 +59,7 @@ class SteamIDView(discord.ui.View):
 class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
     """Steam Whitelist <> Discord bridge"""
     
-    __version__ = "1.0.2"
+    __version__ = "1.1.0"
     __author__ = ["Nevcairiel"]
 
     def __init__(self, bot: commands.Bot):
@@ -63,6 +72,9 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
             "whitelist": [],
             "bans": [],
             "userbans": [],
+            "outputs": [],
+            "output_sequence": 0,
+            "whitelist_hash": "",
         }
         self.config.register_guild(**default_guild)
         
@@ -72,24 +84,103 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
         }
         self.config.register_user(**default_user)
 
+        # debounce settings for writing the whitelist files
+        default_global = {
+            "write_delay": 2.0,
+            "write_max_delay": 30.0,
+        }
+        self.config.register_global(**default_global)
+
+        # in-memory state, seeded once the bot is ready
+        self.steam_ids = SteamIDIndex()
+        self.whitelists: Dict[int, GuildWhitelist] = {}
+        self._settings: Dict[int, GuildSettings] = {}
+        self._loaded = asyncio.Event()
+
+        # pending debounced writes
+        self.write_delay = default_global["write_delay"]
+        self.write_max_delay = default_global["write_max_delay"]
+        self._flush_tasks: Dict[int, asyncio.Task] = {}
+        self._last_change: Dict[int, float] = {}
+        self._write_locks: Dict[int, asyncio.Lock] = {}
+
     async def cog_load(self) -> None:
         self.persistentView = SteamIDView(self)
         self.bot.add_view(self.persistentView)
+        self._init_task = asyncio.create_task(self._initialize())
 
     async def cog_unload(self):
         self.persistentView.stop()
+        self._init_task.cancel()
+
+        # write out anything that is still pending
+        for guild_id, task in list(self._flush_tasks.items()):
+            task.cancel()
+            guild = self.bot.get_guild(guild_id)
+            if guild:
+                await self.flush_whitelist(guild)
+
+    async def _initialize(self) -> None:
+        """Seed the in-memory whitelists, this needs the member cache to be ready"""
+        self.write_delay = await self.config.write_delay()
+        self.write_max_delay = await self.config.write_max_delay()
+
+        await self.bot.wait_until_red_ready()
+
+        all_users = await self.config.all_users()
+        self.steam_ids = SteamIDIndex({user_id: settings["steam_id"] for user_id, settings in all_users.items() if settings["steam_id"]})
+
+        guilds = []
+        hashes = {}
+        all_guilds = await self.config.all_guilds()
+        for guild_id, settings in all_guilds.items():
+            guild = self.bot.get_guild(guild_id)
+            if not guild:
+                continue
+
+            guilds.append((guild, GuildSettings(settings)))
+            self._settings[guild_id] = guilds[-1][1]
+            hashes[guild_id] = settings["whitelist_hash"]
+
+        for (guild, settings), whitelist in zip(guilds, self._build_whitelists(guilds)):
+            # skip writing if the outputs already have these contents
+            if whitelist.content_hash() == hashes[guild.id]:
+                whitelist.mark_written()
+            self.whitelists[guild.id] = whitelist
+
+        self._loaded.set()
+
+        # write anything that changed while the bot was offline
+        await asyncio.gather(*(self.flush_whitelist(guild) for guild, settings in guilds))
 
     def validate_steamid(self, steam_id: str) -> bool:
-        return len(steam_id) == 17 and steam_id[0:5] == "76561" and re.match("^[0-9]*$", steam_id)
+        return STEAMID_REGEX.fullmatch(steam_id) is not None
 
     async def red_delete_data_for_user(self, *, requester: Literal["discord_deleted_user", "owner", "user", "user_strict"], user_id: int):
         """Method for finding users data inside the cog and deleting it."""
         await self.config.user_from_id(user_id).clear()
+        if self.steam_ids.pop(user_id):
+            for guild_id, whitelist in self.whitelists.items():
+                whitelist.set_member(user_id, None)
+                guild = self.bot.get_guild(guild_id)
+                if guild:
+                    self.schedule_flush(guild)
+
+    async def _get_settings(self, guild: discord.Guild) -> GuildSettings:
+        """Get the cached settings of a guild, loading them on first use"""
+        settings = self._settings.get(guild.id)
+        if settings is None:
+            settings = self._settings[guild.id] = GuildSettings(await self.config.guild(guild).all())
+        return settings
+
+    async def _reload_settings(self, guild: discord.Guild) -> None:
+        """Reload the cached settings of a guild, after they were changed"""
+        self._settings[guild.id] = GuildSettings(await self.config.guild(guild).all())
 
     async def user_whitelisted(self, user: discord.Member) -> bool:
         """Check if a user has a whitelisted role"""
-        allowed_roles = await self.config.guild(user.guild).roles()
-        return self.user_whitelisted_internal(user, allowed_roles)
+        settings = await self._get_settings(user.guild)
+        return self.user_whitelisted_internal(user, settings.roles)
     
     def user_whitelisted_internal(self, user: discord.Member, allowed_roles) -> bool:
         """Check if a user has a whitelisted role"""
@@ -98,58 +189,177 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
                 return True
                         
         return False
-    
+
+    def _member_steamid(self, member: discord.Member, settings: GuildSettings) -> Optional[str]:
+        """Get the Steam ID a member contributes to the guild whitelist, if any"""
+        steam_id = self.steam_ids.get(member.id)
+        if not steam_id:
+            return None
+
+        if steam_id in settings.bans or member.id in settings.userbans:
+            return None
+
+        if not self.user_whitelisted_internal(member, settings.roles):
+            return None
+
+        return steam_id
+
+    def _build_whitelist(self, guild: discord.Guild, settings: GuildSettings) -> GuildWhitelist:
+        """Build the whitelist of a guild from scratch"""
+        return self._build_whitelists([(guild, settings)])[0]
+
+    def _build_whitelists(self, guilds: List[Tuple[discord.Guild, GuildSettings]]) -> List[GuildWhitelist]:
+        """Build the whitelists of several guilds from scratch, in one pass over all users"""
+        whitelists = []
+        for guild, settings in guilds:
+            whitelist = GuildWhitelist()
+            for steam_id in settings.whitelist:
+                whitelist.add_static(steam_id)
+            whitelists.append(whitelist)
+
+        for user_id in self.steam_ids:
+            for (guild, settings), whitelist in zip(guilds, whitelists):
+                member = guild.get_member(user_id)
+                if member:
+                    whitelist.set_member(user_id, self._member_steamid(member, settings))
+
+        return whitelists
+
+    async def _get_whitelist(self, guild: discord.Guild) -> Optional[GuildWhitelist]:
+        """Get the in-memory whitelist of a guild, building it on first use"""
+        if not self._loaded.is_set():
+            return None
+
+        whitelist = self.whitelists.get(guild.id)
+        if whitelist is None:
+            settings = await self._get_settings(guild)
+            whitelist = self.whitelists[guild.id] = self._build_whitelist(guild, settings)
+
+        return whitelist
+
+    async def _refresh_member(self, member: discord.Member) -> None:
+        """Re-evaluate a single member of a guild and write any changes"""
+        whitelist = await self._get_whitelist(member.guild)
+        if whitelist is None:
+            return
+
+        settings = await self._get_settings(member.guild)
+        whitelist.set_member(member.id, self._member_steamid(member, settings))
+        self.schedule_flush(member.guild)
+
     async def update_whitelist(self, guild: discord.Guild):
-        whitelist_file = self.config.guild(guild).whitelist_file
-        if not whitelist_file:
+        """Rebuild the whitelist of a guild and write it, if it changed"""
+        await self.update_whitelists([guild])
+
+    async def update_whitelists(self, guilds: List[discord.Guild]):
+        """Rebuild the whitelists of several guilds together, and write the ones that changed"""
+        # commands can run before the in-memory state is seeded, wait for it instead of skipping the update
+        await self._loaded.wait()
+
+        guild_settings = [(guild, await self._get_settings(guild)) for guild in guilds]
+        for guild, whitelist in zip(guilds, self._build_whitelists(guild_settings)):
+            previous = self.whitelists.get(guild.id)
+            if previous:
+                whitelist.written = previous.written
+            self.whitelists[guild.id] = whitelist
+
+        await asyncio.gather(*(self.flush_whitelist(guild) for guild in guilds))
+
+    def schedule_flush(self, guild: discord.Guild) -> None:
+        """Write the whitelist of a guild once changes have settled down
+
+        The write happens after no changes were made for `write_delay` seconds,
+        but no later than `write_max_delay` seconds after the first change.
+        """
+        whitelist = self.whitelists.get(guild.id)
+        if whitelist is None or not whitelist.dirty:
             return
-        
-        allowed_roles = await self.config.guild(guild).roles()
-        
-        steamid_whitelist = []
-        steamid_whitelist += await self.config.guild(guild).whitelist()
 
-        # get bans
-        bans = await self.config.guild(guild).bans()
+        self._last_change[guild.id] = time.monotonic()
+        if guild.id not in self._flush_tasks:
+            self._flush_tasks[guild.id] = asyncio.create_task(self._delayed_flush(guild))
+
+    async def _delayed_flush(self, guild: discord.Guild) -> None:
+        first_change = time.monotonic()
+        while True:
+            deadline = min(self._last_change[guild.id] + self.write_delay, first_change + self.write_max_delay)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        # changes from here on need a new write
+        del self._flush_tasks[guild.id]
+        await self.flush_whitelist(guild)
+
+    async def _get_sinks(self, guild: discord.Guild) -> List[WhitelistSink]:
+        """Get all outputs configured for a guild"""
+        settings = await self._get_settings(guild)
+        sinks = []
+        if settings.whitelist_file:
+            sinks.append(TextFileSink(settings.whitelist_file))
+
+        for output in settings.outputs:
+            sinks.append(SINK_TYPES[output["type"]](output["target"]))
+
+        return sinks
+
+    async def flush_whitelist(self, guild: discord.Guild):
+        """Write the whitelist of a guild to all outputs, if its contents changed"""
+        whitelist = self.whitelists.get(guild.id)
+        if whitelist is None:
+            return
 
-        # get userbans
-        userbans = await self.config.guild(guild).userbans()
+        async with self._write_locks.setdefault(guild.id, asyncio.Lock()):
+            if not whitelist.needs_flush():
+                return
 
-        # collect all users
-        all_users = await self.config.all_users()
-        for user_id, settings in all_users.items():
-            steam_id = settings["steam_id"]
-            if not steam_id:
-                continue
+            sinks = await self._get_sinks(guild)
+            if not sinks:
+                return
 
-            if steam_id in bans:
-                continue
+            entries = whitelist.entries()
+            current = frozenset(entries)
+            previous = whitelist.written or frozenset()
 
-            if user_id in userbans:
-                continue
+            sequence = await self.config.guild(guild).output_sequence() + 1
+            await self.config.guild(guild).output_sequence.set(sequence)
 
-            member = guild.get_member(user_id)
-            if not member:
-                continue
+            update = WhitelistUpdate(guild.id, sequence, entries, current - previous, previous - current, whitelist.written is None)
+            results = await asyncio.gather(*(sink.write(update) for sink in sinks), return_exceptions=True)
+            failed = False
+            for sink, result in zip(sinks, results):
+                if isinstance(result, Exception):
+                    log.error(f"Writing whitelist to {sink.target} failed: {result}")
+                    failed = True
 
-            if self.user_whitelisted_internal(member, allowed_roles):
-                steamid_whitelist.append(steam_id)
+            # keep the whitelist dirty and the previous hash, so the next flush or startup writes it again
+            if failed:
+                return
 
-        filename = await self.config.guild(guild).whitelist_file()
-        filename_tmp = filename + ".tmp"
-        try:
-            with open(filename + ".tmp", "wb") as file:
-                file.write(bytes('\n'.join(steamid_whitelist) + '\n', "utf-8"))
+            whitelist.mark_written(entries)
+            await self.config.guild(guild).whitelist_hash.set(hash_whitelist(entries))
+
+    async def force_flush(self, guild: discord.Guild):
+        """Write the whole whitelist of a guild, even if nothing changed"""
+        whitelist = await self._get_whitelist(guild)
+        if whitelist:
+            whitelist.reset_written()
+            await self.flush_whitelist(guild)
 
-            os.replace(filename_tmp, filename)
-        except Exception as e:
-            log.error(e)
+    async def reconcile_whitelists(self):
+        """Rebuild all whitelists, and write the ones that changed since they were last written"""
+        guilds = [self.bot.get_guild(guild_id) for guild_id in list(self.whitelists)]
+        await self.update_whitelists([guild for guild in guilds if guild])
 
     async def update_all_guilds_for_member(self, user: discord.User):
         """Update all guilds a user is a member of"""
-        all_guilds = await self.config.all_guilds()
-        for g_id, settings in all_guilds.items():
-            guild = self.bot.get_guild(g_id)
+        if not self._loaded.is_set():
+            return
+
+        guilds = []
+        for guild_id, whitelist in list(self.whitelists.items()):
+            guild = self.bot.get_guild(guild_id)
             if not guild:
                 continue
 
@@ -157,8 +367,12 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
             if not member:
                 continue
 
-            if self.user_whitelisted_internal(member, settings["roles"]):
-                await self.update_whitelist(guild)
+            settings = await self._get_settings(guild)
+            whitelist.set_member(user.id, self._member_steamid(member, settings))
+            guilds.append(guild)
+
+        # write all affected guilds at once
+        await asyncio.gather(*(self.flush_whitelist(guild) for guild in guilds))
 
     async def set_steamid(self, steam_id, user, guild) -> bool:
         """Helper function to set and save the steamid of a user"""
@@ -166,16 +380,39 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
         if steam_id:
             if self.validate_steamid(steam_id):
                 await self.config.user(user).steam_id.set(steam_id)
-                if guild:
-                    if await self.user_whitelisted(user):
-                        await self.update_whitelist(guild)
-                else:
-                    await self.update_all_guilds_for_member(user)
+                self.steam_ids.set(user.id, steam_id)
+                # the steam id is shared by all guilds, update each of them
+                await self.update_all_guilds_for_member(user)
 
                 return True
 
         return False
 
+    async def _update_static(self, guild: discord.Guild, steam_id: str, whitelisted: bool) -> None:
+        """Apply a change to the permanent whitelist and write any changes"""
+        whitelist = await self._get_whitelist(guild)
+        if whitelist is None:
+            return
+
+        if whitelisted:
+            whitelist.add_static(steam_id)
+        else:
+            whitelist.remove_static(steam_id)
+        self.schedule_flush(guild)
+
+    async def _refresh_user(self, guild: discord.Guild, user: discord.abc.User) -> None:
+        """Re-evaluate a user in a guild, if they are a member"""
+        member = guild.get_member(user.id)
+        if member:
+            await self._refresh_member(member)
+
+    async def _refresh_steamid(self, guild: discord.Guild, steam_id: str) -> None:
+        """Re-evaluate all members of a guild that claim a Steam ID"""
+        for user_id in self.steam_ids.users(steam_id):
+            member = guild.get_member(user_id)
+            if member:
+                await self._refresh_member(member)
+
     @app_commands.command()
     async def steamid(self, interaction: discord.Interaction, steam_id: str = ""):
         """Set your SteamID to be added to the community server whitelist"""
@@ -255,6 +492,7 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
         async with self.config.guild(ctx.guild).roles() as roles:
             if role.id not in roles:
                 roles.append(role.id)
+        await self._reload_settings(ctx.guild)
         await ctx.send(f"The role {role.mention} has been added to the whitelist. Remember to sync to apply changes.", delete_after=4)
 
     @steamwhitelist.command()
@@ -266,7 +504,8 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
             found = role.id in roles
             if found:
                 roles.remove(role.id)
-        
+        await self._reload_settings(ctx.guild)
+
         if found:
             await ctx.send(f"The role {role.mention} was removed from the whitelist.", delete_after=4)
         else:
@@ -283,8 +522,9 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
         async with self.config.guild(ctx.guild).whitelist() as whitelist:
             if steam_id not in whitelist:
                 whitelist.append(steam_id)
+        await self._reload_settings(ctx.guild)
         await ctx.send("The SteamID has been added to the whitelist.", delete_after=4)
-        await self.update_whitelist(ctx.guild)
+        await self._update_static(ctx.guild, steam_id, True)
 
     @steamwhitelist.command()
     @commands.admin()
@@ -294,10 +534,11 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
             found = steam_id in whitelist
             if found:
                 whitelist.remove(steam_id)
-        
+        await self._reload_settings(ctx.guild)
+
         if found:
             await ctx.send("The SteamID was removed from the whitelist.", delete_after=4)
-            await self.update_whitelist(ctx.guild)
+            await self._update_static(ctx.guild, steam_id, False)
         else:
             await ctx.send("The SteamID was not found.", delete_after=4)
 
@@ -319,10 +560,12 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
         async with self.config.guild(ctx.guild).bans() as bans:
             if steam_id not in bans:
                 bans.append(steam_id)
+        await self._reload_settings(ctx.guild)
 
         # respond
         await ctx.send("The SteamID has been added to the ban list.", delete_after=4)
-        await self.update_whitelist(ctx.guild)
+        await self._update_static(ctx.guild, steam_id, False)
+        await self._refresh_steamid(ctx.guild, steam_id)
 
     @steamwhitelist.command(name = "banuser")
     @commands.admin()
@@ -335,7 +578,7 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
                 bans.append(user.id)
 
         # get the users steamid
-        steam_id = await self.config.user(ctx.author).steam_id()
+        steam_id = self.steam_ids.get(user.id)
 
         # remove from whitelist, if its on there
         if steam_id:
@@ -343,9 +586,13 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
                 found = steam_id in whitelist
                 if found:
                     whitelist.remove(steam_id)
+        await self._reload_settings(ctx.guild)
+
         # respond
         await ctx.send("The User has been added to the ban list.", delete_after=4)
-        await self.update_whitelist(ctx.guild)
+        if steam_id:
+            await self._update_static(ctx.guild, steam_id, False)
+        await self._refresh_user(ctx.guild, user)
 
     @steamwhitelist.command(name = "unban")
     @commands.admin()
@@ -355,10 +602,11 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
             found = steam_id in bans
             if found:
                 bans.remove(steam_id)
+        await self._reload_settings(ctx.guild)
 
         if found:
             await ctx.send("The SteamID was removed from the ban list.", delete_after=4)
-            await self.update_whitelist(ctx.guild)
+            await self._refresh_steamid(ctx.guild, steam_id)
         else:
             await ctx.send("The SteamID was not found.", delete_after=4)
 
@@ -371,13 +619,128 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
             found = user.id in bans
             if found:
                 bans.remove(user.id)
+        await self._reload_settings(ctx.guild)
 
         if found:
             await ctx.send("The User was removed from the ban list.", delete_after=4)
-            await self.update_whitelist(ctx.guild)
+            await self._refresh_user(ctx.guild, user)
         else:
             await ctx.send("The User was not banned", delete_after=4)
 
+    ### bulk management
+    async def _read_steamids(self, ctx: commands.Context, steam_ids: str) -> Tuple[List[str], List[str]]:
+        """Collect Steam IDs from the command and any attached files, returns the valid and invalid entries"""
+        text = steam_ids
+        for attachment in ctx.message.attachments:
+            text += "\n" + (await attachment.read()).decode("utf-8", errors="replace")
+
+        valid = {}
+        invalid = []
+        for entry in STEAMID_SEPARATOR.split(text):
+            if not entry:
+                continue
+            if self.validate_steamid(entry):
+                valid[entry] = None
+            else:
+                invalid.append(entry)
+
+        return list(valid), invalid
+
+    async def _bulk_update(self, ctx: commands.Context, steam_ids: str, update, action: str):
+        """Apply a bulk change to the guild settings in one transaction, and rebuild the whitelist once"""
+        valid, invalid = await self._read_steamids(ctx, steam_ids)
+        if not valid:
+            await ctx.send("No valid SteamIDs were provided. Only SteamID64 is supported (76561...)")
+            return
+
+        async with ctx.typing():
+            async with self.config.guild(ctx.guild).all() as settings:
+                changed = update(settings, valid)
+            await self._reload_settings(ctx.guild)
+            await self.update_whitelist(ctx.guild)
+
+        message = f"{changed} of {len(valid)} SteamIDs were {action}."
+        if invalid:
+            message += f"\n{len(invalid)} invalid entries were skipped: " + ", ".join(invalid[:10])
+            if len(invalid) > 10:
+                message += ", ..."
+        for page in pagify(message):
+            await ctx.send(page)
+
+    @staticmethod
+    def _add_entries(entries: list, steam_ids: List[str]) -> int:
+        existing = set(entries)
+        added = [steam_id for steam_id in steam_ids if steam_id not in existing]
+        entries.extend(added)
+        return len(added)
+
+    @staticmethod
+    def _remove_entries(entries: list, steam_ids: List[str]) -> int:
+        removed = set(steam_ids)
+        remaining = [steam_id for steam_id in entries if steam_id not in removed]
+        count = len(entries) - len(remaining)
+        entries[:] = remaining
+        return count
+
+    @steamwhitelist.group(name = "bulk")
+    @commands.admin()
+    async def bulk(self, ctx: commands.Context):
+        """
+        Manage many Steam IDs at once
+
+        Steam IDs can be separated by spaces, commas or new lines, and can also be provided as attached text files.
+        """
+        pass
+
+    @bulk.command(name = "add")
+    async def bulk_add(self, ctx: commands.Context, *, steam_ids: str = ""):
+        """Add Steam IDs to the permanent whitelist"""
+        def update(settings, valid):
+            return self._add_entries(settings["whitelist"], valid)
+        await self._bulk_update(ctx, steam_ids, update, "added to the whitelist")
+
+    @bulk.command(name = "remove")
+    async def bulk_remove(self, ctx: commands.Context, *, steam_ids: str = ""):
+        """Remove Steam IDs from the permanent whitelist"""
+        def update(settings, valid):
+            return self._remove_entries(settings["whitelist"], valid)
+        await self._bulk_update(ctx, steam_ids, update, "removed from the whitelist")
+
+    @bulk.command(name = "ban")
+    async def bulk_ban(self, ctx: commands.Context, *, steam_ids: str = ""):
+        """Add Steam IDs to the ban list, and remove them from the permanent whitelist"""
+        def update(settings, valid):
+            self._remove_entries(settings["whitelist"], valid)
+            return self._add_entries(settings["bans"], valid)
+        await self._bulk_update(ctx, steam_ids, update, "added to the ban list")
+
+    @bulk.command(name = "unban")
+    async def bulk_unban(self, ctx: commands.Context, *, steam_ids: str = ""):
+        """Remove Steam IDs from the ban list"""
+        def update(settings, valid):
+            return self._remove_entries(settings["bans"], valid)
+        await self._bulk_update(ctx, steam_ids, update, "removed from the ban list")
+
+    @steamwhitelist.command(name = "duplicates")
+    @commands.admin()
+    async def duplicates(self, ctx: commands.Context):
+        """List Steam IDs that are claimed by more than one member"""
+        message = ""
+        for steam_id, user_ids in sorted(self.steam_ids.duplicates().items()):
+            members = [ctx.guild.get_member(user_id) for user_id in sorted(user_ids)]
+            members = [member for member in members if member]
+            if len(members) < 2:
+                continue
+
+            message += f"{steam_id}: " + ", ".join(f"{member.name} ({member.id})" for member in members) + "\n"
+
+        if not message:
+            await ctx.send("No Steam ID is claimed by more than one member.")
+            return
+
+        for page in pagify(message):
+            await ctx.send(page)
+
     @steamwhitelist.command(name = "sync")
     @commands.is_owner()
     async def sync_whitelist(self, ctx: commands.Context):
@@ -401,6 +764,118 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
                 await ctx.send("Whitelist file set.", delete_after=4)
         except:
             await ctx.send("Specified file is not accessible.", delete_after=4)
+            return
+        await self._reload_settings(ctx.guild)
+
+        # the new file is empty, force a write
+        await self.force_flush(ctx.guild)
+
+    @settings_set.command(name = "writedelay")
+    async def set_write_delay(self, ctx: commands.Context, delay: float, max_delay: float = 30.0):
+        """
+        Set how long to wait for changes to settle before writing the whitelist
+
+        - `delay` - Seconds without any changes before the file is written
+        - `max_delay` - Maximum seconds a write is delayed after the first change
+
+        Example:
+            [p]steamwhitelist set writedelay 2 30
+        """
+        if delay < 0 or max_delay < delay:
+            await ctx.send("The delay must be positive, and the maximum delay can't be shorter than the delay.", delete_after=4)
+            return
+
+        await self.config.write_delay.set(delay)
+        await self.config.write_max_delay.set(max_delay)
+        self.write_delay = delay
+        self.write_max_delay = max_delay
+        await ctx.send(f"Whitelist writes are now delayed by {delay}s, up to {max_delay}s.", delete_after=4)
+
+    ### output management
+    @steamwhitelist.group(name = "output")
+    @commands.is_owner()
+    async def output(self, ctx: commands.Context):
+        """
+        Additional outputs for the whitelist
+
+        Supported types:
+        - `text` - File with one Steam ID per line
+        - `json` - JSON file with all Steam IDs and a sequence number
+        - `delta` - Append-only log, one JSON line with added and removed Steam IDs per update
+        - `http` - POST the added and removed Steam IDs as JSON to a URL
+        - `unix` - Send the added and removed Steam IDs as a JSON line to a Unix socket
+        """
+        pass
+
+    @output.command(name = "add")
+    async def output_add(self, ctx: commands.Context, output_type: str, target: str):
+        """
+        Add an output for the whitelist
+
+        Example:
+            [p]steamwhitelist output add delta /srv/game/whitelist.delta
+            [p]steamwhitelist output add http http://127.0.0.1:8080/whitelist
+        """
+        output_type = output_type.lower()
+        sink = SINK_TYPES.get(output_type)
+        if not sink:
+            await ctx.send(f"Unknown output type. Supported types: {', '.join(SINK_TYPES)}", delete_after=4)
+            return
+
+        if not sink.validate(target):
+            await ctx.send("The output target is not valid for this type.", delete_after=4)
+            return
+
+        if sink.is_file:
+            # test if we can open it
+            try:
+                with open(target, "ab"):
+                    pass
+            except:
+                await ctx.send("Specified file is not accessible.", delete_after=4)
+                return
+
+        async with self.config.guild(ctx.guild).outputs() as outputs:
+            entry = {"type": output_type, "target": target}
+            if entry in outputs:
+                await ctx.send("This output is already setup.", delete_after=4)
+                return
+            outputs.append(entry)
+        await self._reload_settings(ctx.guild)
+
+        await ctx.send("Output added.", delete_after=4)
+        # make sure the new output gets the full whitelist
+        await self.force_flush(ctx.guild)
+
+    @output.command(name = "remove")
+    async def output_remove(self, ctx: commands.Context, output_type: str, target: str):
+        """Remove an output for the whitelist"""
+        async with self.config.guild(ctx.guild).outputs() as outputs:
+            entry = {"type": output_type.lower(), "target": target}
+            found = entry in outputs
+            if found:
+                outputs.remove(entry)
+        await self._reload_settings(ctx.guild)
+
+        if found:
+            await ctx.send("Output removed.", delete_after=4)
+        else:
+            await ctx.send("The output was not found.", delete_after=4)
+
+    @output.command(name = "list")
+    async def output_list(self, ctx: commands.Context):
+        """List all outputs for the whitelist"""
+        message = ""
+        filename = await self.config.guild(ctx.guild).whitelist_file()
+        if filename:
+            message += f"file: {filename}\n"
+
+        for output in await self.config.guild(ctx.guild).outputs():
+            message += f"{output['type']}: {output['target']}\n"
+
+        if not message:
+            message = "No outputs setup yet"
+        await ctx.maybe_send_embed(message)
 
     ### button support
     @steamwhitelist.command(name = "sendbutton")
@@ -418,20 +893,30 @@ class SteamWhitelist(commands.Cog, metaclass=CompositeMetaClass):
         await channel.send(content=message, view=self.persistentView)
 
     ### listeners
+    @commands.Cog.listener()
+    async def on_ready(self) -> None:
+        # after a reconnect, catch up on anything missed while disconnected
+        if self._loaded.is_set():
+            await self.reconcile_whitelists()
+
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
-        guild = after.guild
-        allowed_roles = await self.config.guild(after.guild).roles()
-        if not allowed_roles:
+        # all configured guilds are cached once loaded, skip everything else without touching Config
+        settings = self._settings.get(after.guild.id)
+        if settings is None or not settings.roles:
             return
 
+        allowed_roles = settings.roles
+
         was_member = self.user_whitelisted_internal(before, allowed_roles)
         is_member = self.user_whitelisted_internal(after, allowed_roles)
 
         if was_member != is_member:
-            await self.update_whitelist(guild)
+            await self._refresh_member(after)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member) -> None:
-        if await self.user_whitelisted(member):
-            await self.update_whitelist(member.guild)
+        whitelist = self.whitelists.get(member.guild.id)
+        if whitelist is not None:
+            whitelist.set_member(member.id, None)
+            self.schedule_flush(member.guild)
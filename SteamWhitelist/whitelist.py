@@ -0,0 +1,192 @@
+from collections import Counter
+from typing import Dict, FrozenSet, ItemsView, Iterable, Iterator, List, Optional, Set
+
+import hashlib
+import os
+
+
+class SteamIDIndex:
+    """Bidirectional index between Discord users and their Steam IDs
+
+    Several accounts can claim the same Steam ID, those are tracked as they
+    change so they can be reported without scanning all users.
+    """
+
+    def __init__(self, steam_ids: Optional[Dict[int, str]] = None):
+        self._steam_ids: Dict[int, str] = {}
+        self._users: Dict[str, Set[int]] = {}
+        self._duplicates: Set[str] = set()
+        for user_id, steam_id in (steam_ids or {}).items():
+            self.set(user_id, steam_id)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._steam_ids
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._steam_ids)
+
+    def __len__(self) -> int:
+        return len(self._steam_ids)
+
+    def items(self) -> ItemsView[int, str]:
+        return self._steam_ids.items()
+
+    def get(self, user_id: int) -> Optional[str]:
+        """Get the Steam ID of a user"""
+        return self._steam_ids.get(user_id)
+
+    def users(self, steam_id: str) -> FrozenSet[int]:
+        """Get all users that claim a Steam ID"""
+        return frozenset(self._users.get(steam_id, ()))
+
+    def set(self, user_id: int, steam_id: Optional[str]) -> Optional[str]:
+        """Set the Steam ID of a user, None removes it. Returns the previous Steam ID"""
+        previous = self._steam_ids.pop(user_id, None)
+        if previous:
+            users = self._users[previous]
+            users.discard(user_id)
+            if len(users) < 2:
+                self._duplicates.discard(previous)
+            if not users:
+                del self._users[previous]
+
+        if steam_id:
+            self._steam_ids[user_id] = steam_id
+            users = self._users.setdefault(steam_id, set())
+            users.add(user_id)
+            if len(users) > 1:
+                self._duplicates.add(steam_id)
+
+        return previous
+
+    def pop(self, user_id: int) -> Optional[str]:
+        """Remove a user from the index"""
+        return self.set(user_id, None)
+
+    def duplicates(self) -> Dict[str, FrozenSet[int]]:
+        """Get all Steam IDs that are claimed by more than one user"""
+        return {steam_id: frozenset(self._users[steam_id]) for steam_id in self._duplicates}
+
+
+class GuildSettings:
+    """Cached guild settings for building and writing the whitelist
+
+    Lookups are done for every user, so they are kept as frozensets.
+    """
+
+    __slots__ = ("roles", "whitelist", "bans", "userbans", "whitelist_file", "outputs")
+
+    def __init__(self, settings: dict):
+        self.roles: FrozenSet[int] = frozenset(settings["roles"])
+        self.whitelist: FrozenSet[str] = frozenset(settings["whitelist"])
+        self.bans: FrozenSet[str] = frozenset(settings["bans"])
+        self.userbans: FrozenSet[int] = frozenset(settings["userbans"])
+        self.whitelist_file: Optional[str] = settings.get("whitelist_file")
+        self.outputs: List[dict] = settings.get("outputs", [])
+
+
+class GuildWhitelist:
+    """In-memory whitelist of a single guild
+
+    Steam IDs are reference counted, since the same ID can be on the permanent
+    whitelist and be claimed by one or more members at the same time.
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._static = set()
+        self._members: Dict[int, str] = {}
+        self.written: Optional[FrozenSet[str]] = None
+        self.dirty = True
+
+    def __contains__(self, steam_id: str) -> bool:
+        return steam_id in self._counts
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def _ref(self, steam_id: str) -> None:
+        self._counts[steam_id] += 1
+        if self._counts[steam_id] == 1:
+            self.dirty = True
+
+    def _unref(self, steam_id: str) -> None:
+        self._counts[steam_id] -= 1
+        if self._counts[steam_id] <= 0:
+            del self._counts[steam_id]
+            self.dirty = True
+
+    def add_static(self, steam_id: str) -> None:
+        """Add a Steam ID from the permanent whitelist"""
+        if steam_id not in self._static:
+            self._static.add(steam_id)
+            self._ref(steam_id)
+
+    def remove_static(self, steam_id: str) -> None:
+        """Remove a Steam ID from the permanent whitelist"""
+        if steam_id in self._static:
+            self._static.remove(steam_id)
+            self._unref(steam_id)
+
+    def set_member(self, user_id: int, steam_id: Optional[str]) -> None:
+        """Set the Steam ID a member contributes, None removes the member"""
+        previous = self._members.get(user_id)
+        if previous == steam_id:
+            return
+
+        if previous:
+            del self._members[user_id]
+            self._unref(previous)
+
+        if steam_id:
+            self._members[user_id] = steam_id
+            self._ref(steam_id)
+
+    def entries(self) -> List[str]:
+        """Sorted list of all whitelisted Steam IDs"""
+        return sorted(self._counts)
+
+    def content_hash(self) -> str:
+        """Hash of the rendered whitelist, to detect changes across restarts"""
+        return hash_whitelist(self.entries())
+
+    def needs_flush(self) -> bool:
+        """Check if the contents changed since they were last written"""
+        if not self.dirty:
+            return False
+        if self.written is not None and self.written == self._counts.keys():
+            self.dirty = False
+            return False
+        return True
+
+    def reset_written(self) -> None:
+        """Forget what was written, so the next flush writes everything"""
+        self.written = None
+        self.dirty = True
+
+    def mark_written(self, entries: Optional[Iterable[str]] = None) -> None:
+        """Record the entries that were written, defaults to the current contents"""
+        self.written = frozenset(self._counts if entries is None else entries)
+        self.dirty = self.written != self._counts.keys()
+
+
+def render_whitelist(entries: List[str]) -> bytes:
+    """Render the whitelist in the newline-separated file format"""
+    return bytes('\n'.join(entries) + '\n', "utf-8")
+
+
+def hash_whitelist(entries: List[str]) -> str:
+    """Hash of the rendered whitelist"""
+    return hashlib.sha256(render_whitelist(entries)).hexdigest()
+
+
+def write_file_atomic(filename: str, data: bytes) -> None:
+    """Write a file through a temporary file, so readers never see partial contents
+
+    This is blocking, and should be run in an executor
+    """
+    filename_tmp = filename + ".tmp"
+    with open(filename_tmp, "wb") as file:
+        file.write(data)
+
+    os.replace(filename_tmp, filename)
@@ -0,0 +1,195 @@
+"""Benchmark for syncing an AdForum forum with large numbers of threads and role members
+
+Compares the list based checks the forum sync used to do against the ID set
+diff, on synthetic forums. Role edits are counted but not sent anywhere.
+
+Examples:
+    python benchmarks/adforum_sync.py
+    python benchmarks/adforum_sync.py --threads 20000 --members 50000 --role-members 8000
+"""
+import argparse
+import asyncio
+import random
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+# makes the cogs importable, keep it above the cog imports
+from common import add_arguments, bare_cog, measure_async
+
+from AdForum.adforum import AdForum
+
+ROLE_ID = 50
+FORUM_ID = 500
+BASE_DATE = datetime(2024, 1, 1, tzinfo = timezone.utc)
+
+
+### fake Discord objects
+
+class FakeMember:
+    def __init__(self, member_id: int, stats: Counter):
+        self.id = member_id
+        self.role_ids = set()
+        self._stats = stats
+
+    def get_role(self, role_id: int):
+        return role_id if role_id in self.role_ids else None
+
+    async def add_roles(self, role, reason = None) -> None:
+        self._stats["added"] += 1
+
+    async def remove_roles(self, role, reason = None) -> None:
+        self._stats["removed"] += 1
+
+
+class FakeRole:
+    def __init__(self, members: list):
+        self.id = ROLE_ID
+        self.members = members
+
+
+class FakeThread:
+    def __init__(self, thread_id: int, owner_id: int, guild):
+        self.id = thread_id
+        self.owner_id = owner_id
+        self.guild = guild
+        self.archive_timestamp = BASE_DATE - timedelta(minutes = thread_id)
+
+    @property
+    def owner(self):
+        return self.guild.get_member(self.owner_id)
+
+
+class FakeGuild:
+    def __init__(self, members: dict, role: FakeRole):
+        self.id = 1
+        self.chunked = True
+        self._members = members
+        self._role = role
+
+    def get_member(self, member_id: int):
+        return self._members.get(member_id)
+
+    def get_role(self, role_id: int):
+        return self._role if role_id == ROLE_ID else None
+
+
+class FakeForum:
+    def __init__(self, guild: FakeGuild, threads: list, archived: list):
+        self.id = FORUM_ID
+        self.guild = guild
+        self.threads = threads
+        self._archived = archived
+
+    async def archived_threads(self, limit = None):
+        for thread in self._archived:
+            yield thread
+
+
+### fake Config
+
+class FakeValue:
+    def __init__(self, value):
+        self._value = value
+
+    async def __call__(self):
+        return self._value
+
+    async def set_raw(self, *keys, value = None) -> None:
+        pass
+
+    async def clear_raw(self, *keys) -> None:
+        pass
+
+
+class FakeGroup:
+    def __init__(self):
+        self.threads = FakeValue({})
+        self.archive_marks = FakeValue({})
+
+
+class FakeConfig:
+    def __init__(self):
+        self._guild = FakeGroup()
+
+    def guild(self, guild) -> FakeGroup:
+        return self._guild
+
+
+def build_forum(args, rng: random.Random, stats: Counter) -> FakeForum:
+    members = {member_id: FakeMember(member_id, stats) for member_id in range(args.members)}
+
+    # some owners left the guild, their threads have no member
+    owner_pool = range(int(args.members * 1.1))
+    threads = [FakeThread(index, rng.choice(owner_pool), None) for index in range(args.threads)]
+    role_members = [members[member_id] for member_id in rng.sample(range(args.members), args.role_members)]
+    for member in role_members:
+        member.role_ids.add(ROLE_ID)
+
+    guild = FakeGuild(members, FakeRole(role_members))
+    for thread in threads:
+        thread.guild = guild
+
+    active = threads[:args.active]
+    archived = threads[args.active:]
+    return FakeForum(guild, active, archived)
+
+
+async def legacy_sync(forum: FakeForum) -> None:
+    """The list based checks, as the forum sync used to do them"""
+    role = forum.guild.get_role(ROLE_ID)
+    role_members = role.members
+    user_list = []
+    for thread in forum.threads:
+        user_list.append(thread.owner)
+        if not thread.owner:
+            pass
+        elif thread.owner not in role_members:
+            await thread.owner.add_roles(role, reason = "AdForum Thread sync")
+
+    async for thread in forum.archived_threads(limit = None):
+        user_list.append(thread.owner)
+        if not thread.owner:
+            pass
+        elif thread.owner not in role_members:
+            await thread.owner.add_roles(role, reason = "AdForum Thread sync")
+
+    for member in role_members:
+        if member not in user_list:
+            await member.remove_roles(role, reason = "AdForum Thread sync")
+
+
+async def run(args) -> None:
+    rng = random.Random(42)
+
+    cog = bare_cog(AdForum, config=FakeConfig(), _forums={1: {FORUM_ID: ROLE_ID}}, _threads={})
+
+    stats = Counter()
+    forum = build_forum(args, rng, stats)
+    print(f"threads={args.threads} members={args.members} role_members={args.role_members}")
+
+    sync_time = await measure_async(lambda: cog._sync_forum(forum), args.repeat)
+    sync_edits = dict(stats)
+    print(f"id sets:   {sync_time * 1000:10.2f} ms ({sync_edits.get('added', 0) // args.repeat} added, {sync_edits.get('removed', 0) // args.repeat} removed)")
+
+    if not args.skip_legacy:
+        stats.clear()
+        legacy_time = await measure_async(lambda: legacy_sync(forum), args.repeat)
+        legacy_edits = dict(stats)
+        print(f"lists:     {legacy_time * 1000:10.2f} ms ({legacy_edits.get('added', 0) // args.repeat} added, {legacy_edits.get('removed', 0) // args.repeat} removed)")
+        print(f"speedup:   {legacy_time / sync_time:10.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--threads", type=int, default=5000, help="threads in the forum")
+    parser.add_argument("--active", type=int, default=200, help="threads that are not archived")
+    parser.add_argument("--members", type=int, default=20000, help="members in the guild")
+    parser.add_argument("--role-members", type=int, default=3000, help="members that have the forum role")
+    add_arguments(parser, legacy="ID set")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""Offline replay benchmark for the CFModUpdateTracker cog
+
+Runs the update poller of CFModTracker against a local stand-in for the
+CurseForge API, using fake guilds, channels and Config, and reports the
+cycle time, the number of API requests and the number of messages sent.
+
+Fixtures can either be synthetic (the default) or loaded from a JSON file
+recorded from the real API, in the form:
+
+    {
+        "mods": {"<modId>": <data of /v1/mods/<modId>>, ...},
+        "changelogs": {"<modId>": "<html changelog>", ...}
+    }
+
+Examples:
+    python benchmarks/cfmod_replay.py --mods 1000 --guilds 100
+    python benchmarks/cfmod_replay.py --scenario burst --releases 250
+    python benchmarks/cfmod_replay.py --fixtures recorded.json --cycles 3
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CFModUpdateTracker.cfmod import CFModTracker  # noqa: E402
+
+API_KEY = "replay-api-key"
+BASE_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+### fake CurseForge API
+
+def synthetic_fixtures(mod_count: int) -> dict:
+    """Generate a set of mods that look like CurseForge API responses"""
+    mods = {}
+    changelogs = {}
+    for index in range(mod_count):
+        mod_id = str(100000 + index)
+        mods[mod_id] = {
+            "id": int(mod_id),
+            "name": f"Replay Mod {index}",
+            "links": {"websiteUrl": f"https://www.curseforge.com/replay/mods/{mod_id}"},
+            "logo": {"thumbnailUrl": f"https://media.forgecdn.net/avatars/thumbnails/{mod_id}.png"},
+            "latestFiles": [{
+                "id": 1,
+                "fileDate": BASE_DATE.isoformat(),
+                "fileFingerprint": int(mod_id) * 31,
+            }],
+        }
+        changelogs[mod_id] = "<ul>" + "".join(f"<li>Change {i} in mod {index}</li>" for i in range(10)) + "</ul>"
+    return {"mods": mods, "changelogs": changelogs}
+
+
+class FakeCurseForge:
+    """Serves fixtures on the /v1/mods endpoints from a background thread
+
+    The cog uses blocking HTTP calls, so the server needs its own event loop
+    """
+
+    def __init__(self, fixtures: dict):
+        self.mods = copy.deepcopy(fixtures["mods"])
+        self.changelogs = dict(fixtures.get("changelogs", {}))
+        self.requests = Counter()
+        self.port = None
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def release(self, mod_ids, when: datetime) -> None:
+        """Publish a new file for each of the given mods"""
+        for mod_id in mod_ids:
+            latest = self.mods[mod_id]["latestFiles"][0]
+            self.mods[mod_id]["latestFiles"] = [{
+                "id": latest["id"] + 1,
+                "fileDate": when.isoformat(),
+                "fileFingerprint": latest["fileFingerprint"] + 1,
+            }]
+
+    async def _get_mod(self, request: web.Request) -> web.Response:
+        self.requests["mod"] += 1
+        mod = self.mods.get(request.match_info["modId"])
+        if not mod:
+            return web.json_response({"error": "not found"}, status=404)
+        return web.json_response({"data": mod})
+
+    async def _get_changelog(self, request: web.Request) -> web.Response:
+        self.requests["changelog"] += 1
+        changelog = self.changelogs.get(request.match_info["modId"], "<p>No changelog</p>")
+        return web.json_response({"data": changelog})
+
+    async def _start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/v1/mods/{modId}", self._get_mod)
+        app.router.add_get("/v1/mods/{modId}/files/{fileId}/changelog", self._get_changelog)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._start())
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="fake-curseforge", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+### fake discord / Red objects
+
+class FakeValue:
+    def __init__(self, store: dict, key: str):
+        self._store = store
+        self._key = key
+
+    async def __call__(self):
+        # Red hands out copies, so mutations are only persisted through set()
+        return copy.deepcopy(self._store[self._key])
+
+    async def set(self, value) -> None:
+        self._store[self._key] = copy.deepcopy(value)
+
+
+class FakeGroup:
+    def __init__(self, store: dict):
+        self._store = store
+
+    def __getattr__(self, key: str) -> FakeValue:
+        return FakeValue(self._store, key)
+
+
+class FakeConfig(FakeGroup):
+    """Minimal stand-in for the parts of Red's Config the cog uses"""
+
+    def __init__(self, api_key: str, interval: int = 300):
+        super().__init__({"api_key": api_key, "interval": interval})
+        self.guilds = {}
+
+    def guild(self, guild) -> FakeGroup:
+        return FakeGroup(self.guilds.setdefault(guild.id, {"subscriptions": [], "use_embeds": True}))
+
+
+class FakeMessage:
+    def __init__(self, stats: Counter):
+        self._stats = stats
+
+    async def publish(self) -> None:
+        self._stats["publishes"] += 1
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, stats: Counter):
+        self.id = channel_id
+        self.name = f"updates-{channel_id}"
+        self._stats = stats
+
+    def permissions_for(self, member) -> SimpleNamespace:
+        return SimpleNamespace(send_messages=True, embed_links=True)
+
+    async def send(self, content=None, **kwargs) -> FakeMessage:
+        self._stats["embeds" if kwargs.get("embed") else "messages"] += 1
+        return FakeMessage(self._stats)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.me = SimpleNamespace(id=1)
+        self.default_role = SimpleNamespace(id=guild_id, mention="@everyone")
+
+
+class FakeBot:
+    def __init__(self):
+        self.guilds = []
+        self.channels = {}
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    async def wait_until_red_ready(self) -> None:
+        pass
+
+
+### scenarios
+
+def build_cog(server: FakeCurseForge, guild_count: int, subs_per_guild: int, use_embeds: bool, publish: bool):
+    stats = Counter()
+    bot = FakeBot()
+    config = FakeConfig(API_KEY)
+    mod_ids = list(server.mods.keys())
+    for index in range(guild_count):
+        guild = FakeGuild(10000 + index)
+        channel = FakeChannel(20000 + index, stats)
+        bot.guilds.append(guild)
+        bot.channels[channel.id] = channel
+
+        subs = []
+        for offset in range(subs_per_guild):
+            mod_id = mod_ids[(index + offset) % len(mod_ids)]
+            latest = server.mods[mod_id]["latestFiles"][0]
+            sub = {
+                "id": mod_id,
+                "channel": {"name": channel.name, "id": channel.id},
+                "publish": publish,
+                "previous_date": latest["fileDate"],
+                "previous_fingerprint": latest["fileFingerprint"],
+                "name": server.mods[mod_id]["name"],
+            }
+            subs.append(sub)
+        config.guilds[guild.id] = {"subscriptions": subs, "use_embeds": use_embeds}
+
+    # skip Cog.__init__, it would register with Red's Config and start the background loop
+    cog = CFModTracker.__new__(CFModTracker)
+    cog.bot = bot
+    cog.conf = config
+    cog.api_base = server.base_url
+    return cog, stats
+
+
+async def run_cycle(cog: CFModTracker, server: FakeCurseForge, stats: Counter) -> dict:
+    server.requests.clear()
+    stats.clear()
+    start = time.perf_counter()
+    await cog.background_check_updates.coro(cog)
+    elapsed = time.perf_counter() - start
+    return {
+        "cycle_seconds": round(elapsed, 4),
+        "mod_requests": server.requests["mod"],
+        "changelog_requests": server.requests["changelog"],
+        "embeds_sent": stats["embeds"],
+        "messages_sent": stats["messages"],
+        "publishes": stats["publishes"],
+    }
+
+
+async def run(args) -> list:
+    if args.fixtures:
+        with open(args.fixtures, "r", encoding="utf-8") as file:
+            fixtures = json.load(file)
+    else:
+        fixtures = synthetic_fixtures(args.mods)
+
+    server = FakeCurseForge(fixtures)
+    server.start()
+    try:
+        subs_per_guild = min(args.subs_per_guild or len(server.mods), len(server.mods))
+        cog, stats = build_cog(server, args.guilds, subs_per_guild, not args.no_embeds, args.publish)
+
+        results = []
+        release_ids = list(server.mods.keys())[:args.releases]
+        for cycle in range(args.cycles):
+            if args.scenario == "burst" and cycle > 0:
+                # every following cycle sees a wave of simultaneous releases
+                server.release(release_ids, BASE_DATE + timedelta(hours=cycle))
+            result = await run_cycle(cog, server, stats)
+            result["cycle"] = cycle
+            results.append(result)
+        return results
+    finally:
+        server.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", choices=("steady", "burst"), default="steady",
+                        help="steady: no new files, burst: simultaneous releases after the first cycle")
+    parser.add_argument("--mods", type=int, default=1000, help="number of synthetic mods")
+    parser.add_argument("--guilds", type=int, default=100, help="number of guilds")
+    parser.add_argument("--subs-per-guild", type=int, default=0, help="subscriptions per guild (default: all mods)")
+    parser.add_argument("--releases", type=int, default=100, help="mods released per burst")
+    parser.add_argument("--cycles", type=int, default=2, help="number of poll cycles to run")
+    parser.add_argument("--fixtures", help="JSON file with recorded API responses")
+    parser.add_argument("--no-embeds", action="store_true", help="post plain text messages instead of embeds")
+    parser.add_argument("--publish", action="store_true", help="publish every posted message")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    columns = ("cycle", "cycle_seconds", "mod_requests", "changelog_requests", "embeds_sent", "messages_sent", "publishes")
+    print("  ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print("  ".join(f"{result[column]:>18}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
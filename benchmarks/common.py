@@ -0,0 +1,51 @@
+"""Helpers shared by the benchmark scripts
+
+Importing this module makes the cogs in the repository importable, so the
+scripts can be run directly from a checkout.
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Awaitable, Callable, Optional, Type, TypeVar
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+T = TypeVar("T")
+
+
+def bare_cog(cls: Type[T], **attrs) -> T:
+    """Create a cog without running Cog.__init__, so no bot or Config is needed"""
+    cog = cls.__new__(cls)
+    for name, value in attrs.items():
+        setattr(cog, name, value)
+    return cog
+
+
+def add_arguments(parser: argparse.ArgumentParser, legacy: Optional[str] = None) -> None:
+    """Add the arguments all benchmarks take, and --skip-legacy if there is a legacy version to compare against"""
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best is reported")
+    if legacy:
+        parser.add_argument("--skip-legacy", action="store_true", help=f"only measure the {legacy} version")
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    """Best time of `repeat` runs of func, in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+async def measure_async(func: Callable[[], Awaitable[object]], repeat: int) -> float:
+    """Best time of `repeat` runs of the coroutine function func, in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -0,0 +1,83 @@
+"""Benchmark for the LinkedRoles dry-run planner on a large synthetic guild
+
+Measures the time and memory needed to plan the role changes of all members,
+and reports how many role edits processing all members would make.
+
+Examples:
+    python benchmarks/linkedroles_plan.py
+    python benchmarks/linkedroles_plan.py --members 200000 --linked 100 --refs 40
+"""
+import argparse
+import random
+import tracemalloc
+
+# makes the cogs importable, keep it above the cog imports
+from common import add_arguments, measure
+
+from LinkedRoles.roles import LinkedRoleIndex, plan_guild_roles
+
+
+def build_guild(args, rng: random.Random):
+    linked_ids = [1000 + index for index in range(args.linked)]
+    ref_ids = [2000 + index for index in range(args.refs)]
+    other_ids = [3000 + index for index in range(args.other)]
+
+    linked_roles = {str(role_id): rng.sample(ref_ids, rng.randint(1, 3)) for role_id in linked_ids}
+
+    members = []
+    stored_roles = {}
+    for member_id in range(args.members):
+        roles = set(rng.sample(other_ids, min(len(other_ids), 3)))
+        if rng.random() < args.linked_share:
+            roles.update(rng.sample(linked_ids, rng.randint(1, 4)))
+            roles.update(rng.sample(ref_ids, rng.randint(0, 3)))
+        if rng.random() < args.stored_share:
+            stored_roles[member_id] = rng.sample(linked_ids, rng.randint(1, 3))
+            roles.update(rng.sample(ref_ids, rng.randint(0, 2)))
+        members.append((member_id, roles))
+
+    existing_roles = set(linked_ids) | set(ref_ids) | set(other_ids)
+    return linked_roles, members, stored_roles, existing_roles
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--members", type=int, default=100000, help="members in the guild")
+    parser.add_argument("--linked", type=int, default=50, help="linked roles")
+    parser.add_argument("--refs", type=int, default=20, help="reference roles")
+    parser.add_argument("--other", type=int, default=30, help="roles without linked role configuration")
+    parser.add_argument("--linked-share", type=float, default=0.3, help="share of members with linked roles")
+    parser.add_argument("--stored-share", type=float, default=0.1, help="share of members with stored roles")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    linked_roles, members, stored_roles, existing_roles = build_guild(args, rng)
+    index = LinkedRoleIndex(linked_roles)
+
+    print(f"members={args.members} linked={args.linked} refs={args.refs} stored={len(stored_roles)}")
+
+    plan = None
+
+    def run_plan():
+        nonlocal plan
+        plan = plan_guild_roles(index, iter(members), stored_roles, existing_roles)
+
+    best = measure(run_plan, args.repeat)
+
+    # measured separately, tracing slows down the planning considerably
+    tracemalloc.start()
+    plan_guild_roles(index, iter(members), stored_roles, existing_roles)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"planning time:  {best * 1000:10.2f} ms ({best / args.members * 1e6:.2f} us per member)")
+    print(f"planning peak:  {peak / 1024:10.1f} KiB")
+    print(f"role edits:     {plan.edits:10d} of {plan.members} members")
+    print(f"stored changes: {plan.stored:10d}")
+    print(f"roles added:    {sum(plan.added.values()):10d}")
+    print(f"roles removed:  {sum(plan.removed.values()):10d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Micro-benchmark for building a SteamWhitelist guild whitelist with large ban lists
+
+Compares the list based membership checks the whitelist generation used to
+do against the cached frozenset settings, on a synthetic guild.
+
+Examples:
+    python benchmarks/steamwhitelist_bans.py
+    python benchmarks/steamwhitelist_bans.py --users 50000 --bans 20000 --roles 50
+"""
+import argparse
+import random
+from types import SimpleNamespace
+
+# makes the cogs importable, keep it above the cog imports
+from common import add_arguments, bare_cog, measure
+
+from SteamWhitelist.steamwhitelist import SteamWhitelist
+from SteamWhitelist.whitelist import GuildSettings, SteamIDIndex
+
+
+def steam_id(index: int) -> str:
+    return f"76561{index:012d}"
+
+
+class FakeGuild:
+    def __init__(self, members: dict):
+        self.id = 1
+        self._members = members
+
+    def get_member(self, user_id: int):
+        return self._members.get(user_id)
+
+
+def build_guild(args, rng: random.Random):
+    roles = [SimpleNamespace(id=1000 + index) for index in range(args.roles)]
+    allowed_roles = [role.id for role in roles[:max(1, args.roles // 5)]]
+
+    members = {}
+    steam_ids = {}
+    for user_id in range(args.users):
+        members[user_id] = SimpleNamespace(id=user_id, roles=rng.sample(roles, min(len(roles), args.roles_per_member)))
+        steam_ids[user_id] = steam_id(user_id)
+
+    settings = {
+        "roles": allowed_roles,
+        "whitelist": [steam_id(args.users + index) for index in range(args.static)],
+        "bans": [steam_id(index) for index in rng.sample(range(args.users * 2), args.bans)],
+        "userbans": rng.sample(range(args.users * 2), args.userbans),
+    }
+    return FakeGuild(members), steam_ids, settings
+
+
+def legacy_build(cog: SteamWhitelist, guild: FakeGuild, settings: dict) -> list:
+    """The list based checks, as the whitelist generation used to do them"""
+    steamid_whitelist = list(settings["whitelist"])
+    for user_id, steam_id in cog.steam_ids.items():
+        if steam_id in settings["bans"]:
+            continue
+
+        if user_id in settings["userbans"]:
+            continue
+
+        member = guild.get_member(user_id)
+        if not member:
+            continue
+
+        if cog.user_whitelisted_internal(member, settings["roles"]):
+            steamid_whitelist.append(steam_id)
+
+    return steamid_whitelist
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=20000, help="members with a Steam ID")
+    parser.add_argument("--bans", type=int, default=5000, help="banned Steam IDs")
+    parser.add_argument("--userbans", type=int, default=2000, help="banned users")
+    parser.add_argument("--static", type=int, default=500, help="permanently whitelisted Steam IDs")
+    parser.add_argument("--roles", type=int, default=50, help="roles in the guild")
+    parser.add_argument("--roles-per-member", type=int, default=5, help="roles each member has")
+    add_arguments(parser, legacy="frozenset")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    guild, steam_ids, settings = build_guild(args, rng)
+
+    cog = bare_cog(SteamWhitelist, steam_ids=SteamIDIndex(steam_ids))
+
+    cached = None
+
+    def run_cached():
+        nonlocal cached
+        cached = cog._build_whitelist(guild, GuildSettings(settings)).entries()
+
+    print(f"users={args.users} bans={args.bans} userbans={args.userbans} roles={args.roles}")
+    cached_time = measure(run_cached, args.repeat)
+    print(f"frozenset settings: {cached_time * 1000:10.2f} ms ({len(cached)} entries)")
+
+    if not args.skip_legacy:
+        legacy = None
+
+        def run_legacy():
+            nonlocal legacy
+            legacy = legacy_build(cog, guild, settings)
+
+        legacy_time = measure(run_legacy, args.repeat)
+        print(f"list settings:      {legacy_time * 1000:10.2f} ms ({len(set(legacy))} entries)")
+        print(f"speedup:            {legacy_time / cached_time:10.1f}x")
+        assert sorted(set(legacy)) == cached, "whitelist contents differ"
+
+
+if __name__ == "__main__":
+    main()